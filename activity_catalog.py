@@ -0,0 +1,147 @@
+# Functions related to the SQLite catalog of activities in the gpx files
+
+import concurrent.futures
+import os
+import sqlite3
+from datetime import datetime
+
+from configuration import *
+from gpx_cache import get_file_digest, load_gpx_points
+from gpx_files import get_datetime_from_gpx, sort_gpx_filenames_and_dates
+from route_bounds import CoordinateSummary
+from util import current_directory
+
+CATALOG_VERSION = 1
+
+# The activities table has a row per gpx file. activity_bounds is an R*Tree index of the bounding boxes of the routes
+# with the same ids, for finding the activities in an area without looking at every row. The R*Tree keeps the boxes as
+# 32-bit floats rounded outwards, so the exact bounds are in the activities table.
+CATALOG_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS activities (
+        id INTEGER PRIMARY KEY,
+        path TEXT UNIQUE NOT NULL,
+        folder TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        sha1 TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        point_count INTEGER NOT NULL,
+        lat_sum REAL NOT NULL,
+        lon_sum REAL NOT NULL,
+        min_lat REAL,
+        max_lat REAL,
+        min_lon REAL,
+        max_lon REAL
+    );
+    CREATE INDEX IF NOT EXISTS activities_folder_start_time ON activities (folder, start_time);
+    CREATE VIRTUAL TABLE IF NOT EXISTS activity_bounds USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+    '''
+
+
+def open_catalog():
+    """Open the catalog at ACTIVITY_CATALOG, creating it if needed. A catalog of an older version is started over."""
+    catalog_path = os.path.join(current_directory, ACTIVITY_CATALOG)
+    connection = sqlite3.connect(catalog_path)
+    if connection.execute('PRAGMA user_version').fetchone()[0] != CATALOG_VERSION:
+        connection.executescript('DROP TABLE IF EXISTS activities; DROP TABLE IF EXISTS activity_bounds;')
+        connection.executescript(CATALOG_SCHEMA)
+        connection.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+    return connection
+
+def get_catalog_folder(input_folder):
+    # The same folder path the rest of the program joins the gpx file names to
+    return os.path.join(current_directory, input_folder)
+
+def get_activity_record(file_path, size, mtime_ns):
+    """Read the catalog row of a gpx file. Runs in the worker processes."""
+    print(f'\r{file_path}    ', end='', flush=True)
+    points = load_gpx_points(file_path)
+    summary = CoordinateSummary()
+    summary.add(points.latitudes, points.longitudes)
+    start_time = get_datetime_from_gpx(file_path).isoformat()
+    bounds = (summary.min_lat, summary.max_lat, summary.min_lon, summary.max_lon) if summary.count else (None, None, None, None)
+    return (file_path, os.path.dirname(file_path), size, mtime_ns, get_file_digest(file_path), start_time,
+            summary.count, summary.lat_sum, summary.lon_sum) + bounds
+
+def update_catalog(connection, input_folder, number_of_workers):
+    """Bring the catalog up to date with the gpx files in the input folder.
+    Only new files and files whose size or modification time changed are read. Returns the number of files read."""
+    folder = get_catalog_folder(input_folder)
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith('.gpx') and entry.is_file():
+                stat = entry.stat()
+                files[os.path.join(folder, entry.name)] = (stat.st_size, stat.st_mtime_ns)
+
+    cataloged = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 connection.execute('SELECT path, size, mtime_ns FROM activities WHERE folder = ?', (folder,))}
+    removed = [(path,) for path in cataloged if path not in files]
+    changed = [(path, size, mtime_ns) for path, (size, mtime_ns) in files.items() if cataloged.get(path) != (size, mtime_ns)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+        records = list(executor.map(get_activity_record, *zip(*changed))) if changed else []
+    with connection:
+        removed += [(record[0],) for record in records if record[0] in cataloged]
+        connection.executemany('DELETE FROM activity_bounds WHERE id = (SELECT id FROM activities WHERE path = ?)', removed)
+        connection.executemany('DELETE FROM activities WHERE path = ?', removed)
+        for record in records:
+            cursor = connection.execute('INSERT INTO activities (path, folder, size, mtime_ns, sha1, start_time, point_count, lat_sum, lon_sum, '
+                                        'min_lat, max_lat, min_lon, max_lon) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', record)
+            # Files without points have no bounding box and are never in an area
+            if record[6]:
+                connection.execute('INSERT INTO activity_bounds VALUES (?, ?, ?, ?, ?)', (cursor.lastrowid,) + record[9:])
+    if changed:
+        print('\r                                                              \r', end='')
+    return len(changed)
+
+def select_activities(connection, input_folder, bounds=None, start_date=None, end_date=None):
+    """Get the activities in the input folder whose routes' bounding boxes intersect bounds (min_lat, max_lat, min_lon, max_lon)
+    and that start on or after start_date and before end_date. Dates are datetimes or ISO format strings, None leaves that side open.
+    Returns a list of (file path, start time) and a CoordinateSummary of the selected routes."""
+    query = ('SELECT path, start_time, point_count, lat_sum, lon_sum, min_lat, max_lat, min_lon, max_lon '
+             'FROM activities WHERE folder = ?')
+    parameters = [get_catalog_folder(input_folder)]
+    if bounds is not None:
+        min_lat, max_lat, min_lon, max_lon = bounds
+        # The R*Tree finds the candidates, whose exact bounds are then checked, as its rounded boxes can be slightly too large
+        intersects = 'max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?'
+        query += f' AND id IN (SELECT id FROM activity_bounds WHERE {intersects}) AND {intersects}'
+        parameters += [min_lat, max_lat, min_lon, max_lon] * 2
+    if start_date is not None:
+        query += ' AND start_time >= ?'
+        parameters.append(get_catalog_time(start_date))
+    if end_date is not None:
+        query += ' AND start_time < ?'
+        parameters.append(get_catalog_time(end_date))
+
+    files_with_dates = []
+    summary = CoordinateSummary()
+    for path, start_time, point_count, lat_sum, lon_sum, min_lat, max_lat, min_lon, max_lon in connection.execute(query, parameters):
+        files_with_dates.append((path, datetime.fromisoformat(start_time)))
+        if point_count:
+            route = CoordinateSummary()
+            route.count, route.lat_sum, route.lon_sum = point_count, lat_sum, lon_sum
+            route.min_lat, route.max_lat, route.min_lon, route.max_lon = min_lat, max_lat, min_lon, max_lon
+            summary.merge(route)
+    return files_with_dates, summary
+
+def get_catalog_time(date):
+    """Get a date as the text it's compared with in the catalog"""
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date)
+    return date.isoformat()
+
+def get_selected_activities(number_of_workers, bounds=None, start_date=None, end_date=None):
+    """Update the catalog with the input folder and select the activities to render, see select_activities.
+    Returns the sorted list of (file path, start time) and a CoordinateSummary of the selected routes."""
+    connection = open_catalog()
+    try:
+        read_count = update_catalog(connection, INPUT_FOLDER, number_of_workers)
+        if read_count:
+            print(f'{read_count} new or changed gpx files added to the activity catalog.')
+        files_with_dates, summary = select_activities(connection, INPUT_FOLDER, bounds, start_date, end_date)
+    finally:
+        connection.close()
+    sort_gpx_filenames_and_dates(files_with_dates)
+    return files_with_dates, summary
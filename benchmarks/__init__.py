@@ -0,0 +1 @@
+# Benchmarks of the timelapse creator. See stage_benchmarks.py and gpx_reader_benchmark.py for usage.
@@ -0,0 +1,86 @@
+# Compares the streaming gpx reader against parsing with gpxpy.
+# Usage: python benchmarks/gpx_reader_benchmark.py [gpx files...]
+# Without arguments, a large synthetic 1 Hz recording is generated and used.
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import gpxpy
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gpx_reader import read_gpx_points
+
+
+def write_large_gpx(file_path, point_count=200000, segment_count=4):
+    """Write a deterministic random walk recorded at 1 Hz"""
+    rng = random.Random(0)
+    lat = 60.17
+    lon = 24.94
+    point_time = datetime(2024, 1, 1)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        file.write('<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        file.write(f'<metadata><time>{point_time:%Y-%m-%dT%H:%M:%SZ}</time></metadata>\n<trk>\n')
+        for _ in range(segment_count):
+            file.write('<trkseg>\n')
+            for _ in range(point_count // segment_count):
+                lat += rng.uniform(-0.0001, 0.0001)
+                lon += rng.uniform(-0.0001, 0.0001)
+                point_time += timedelta(seconds=1)
+                file.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>12.3</ele><time>{point_time:%Y-%m-%dT%H:%M:%SZ}</time></trkpt>\n')
+            file.write('</trkseg>\n')
+        file.write('</trk>\n</gpx>\n')
+
+def read_with_gpxpy(data):
+    gpx = gpxpy.parse(data.decode('utf-8'))
+    latitudes = []
+    longitudes = []
+    times = []
+    offsets = [0]
+    for track in gpx.tracks:
+        for segment in track.segments:
+            for point in segment.points:
+                latitudes.append(point.latitude)
+                longitudes.append(point.longitude)
+                times.append(point.time.timestamp() if point.time else np.nan)
+            offsets.append(len(latitudes))
+    return np.array([latitudes, longitudes, times], dtype=np.float64).reshape(3, -1), offsets
+
+def measure(function, data):
+    """Time a run on its own, then measure peak memory in a second run because tracemalloc slows everything down"""
+    start_time = time.perf_counter()
+    result = function(data)
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    function(data)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak_memory
+
+def main(file_paths):
+    if not file_paths:
+        file_paths = [os.path.join(tempfile.gettempdir(), 'gpx_reader_benchmark.gpx')]
+        if not os.path.exists(file_paths[0]):
+            print(f'Writing {file_paths[0]}')
+            write_large_gpx(file_paths[0])
+
+    for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        (gpxpy_points, gpxpy_offsets), gpxpy_time, gpxpy_memory = measure(read_with_gpxpy, data)
+        (points, offsets, _), reader_time, reader_memory = measure(read_gpx_points, data)
+
+        same_output = offsets == gpxpy_offsets and np.array_equal(points, gpxpy_points, equal_nan=True)
+        print(f'{os.path.basename(file_path)}: {points.shape[1]} points, {len(data) / 1e6:.1f} MB, same output: {same_output}')
+        print(f'  gpxpy:  {gpxpy_time:7.2f} s  {gpxpy_memory / 1e6:8.1f} MB peak')
+        print(f'  reader: {reader_time:7.2f} s  {reader_memory / 1e6:8.1f} MB peak  ({gpxpy_time / reader_time:.1f}x faster)')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,285 @@
+# Times the stages of the timelapse creator on synthetic gpx corpora, and writes the results as JSON.
+# Usage: python -m benchmarks.stage_benchmarks [--files 100 1000 10000] [--stages dates bounds ...] [--renderer html|native] [--output results.json]
+# Each stage runs in a process of its own, in a work folder whose configuration.py points the program to the corpus and the work folder.
+# The map tiles are stubs, so nothing is downloaded. Capturing with the html renderer needs Chrome like a normal run.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then left out of the results
+    resource = None
+
+from benchmarks.synthetic_gpx import generate_corpus
+from benchmarks.stub_tiles import write_stub_tiles
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['dates', 'catalog', 'bounds', 'map_build', 'capture', 'timestamps']
+
+
+def get_peak_rss():
+    """Peak resident memory in bytes of this process and of its finished child processes"""
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+# The functions below run in the stage process, where configuration is the work folder's configuration.py
+
+def get_map_view():
+    """Find the map view like a normal run does, with stub tiles in place of the downloads. Returns the zoom level and center."""
+    from configuration import EXTRA_MAP_TILES, FRACTIONAL_ZOOM, MAP_HEIGHT, MAP_WIDTH, number_of_workers
+    from gpx_files import get_center_and_bounds
+    from map_tiles import get_zoom_level
+    from native_map import TILE_FOLDER
+    from output_targets import get_tile_ranges
+
+    center_lat, center_lon, min_lat, max_lat, min_lon, max_lon = get_center_and_bounds(get_gpx_files(), number_of_workers)
+    zoom_level = get_zoom_level(min_lat, max_lat, min_lon, max_lon, MAP_WIDTH, MAP_HEIGHT, fractional=FRACTIONAL_ZOOM)
+    view = (zoom_level, center_lat, center_lon, (min_lat, max_lat, min_lon, max_lon))
+    [(tile_zoom, (min_x, max_x, min_y, max_y))] = get_tile_ranges([{'size': (MAP_WIDTH, MAP_HEIGHT)}], [view]).items()
+    write_stub_tiles(TILE_FOLDER, tile_zoom, min_x - EXTRA_MAP_TILES, max_x + EXTRA_MAP_TILES, min_y - EXTRA_MAP_TILES, max_y + EXTRA_MAP_TILES)
+    return zoom_level, center_lat, center_lon
+
+def get_gpx_files():
+    from configuration import INPUT_FOLDER
+    return [os.path.join(INPUT_FOLDER, f) for f in sorted(os.listdir(INPUT_FOLDER)) if f.endswith('.gpx')]
+
+def prepare_dates(renderer):
+    from gpx_files import get_gpx_filenames_and_dates
+    return lambda: len(get_gpx_filenames_and_dates()), 'files'
+
+def prepare_catalog(renderer):
+    """Bring the activity catalog up to date, then time selecting the activities in the middle of the corpus area"""
+    from configuration import INPUT_FOLDER, number_of_workers
+    from activity_catalog import open_catalog, select_activities, update_catalog
+    from benchmarks.synthetic_gpx import CENTER_LAT, CENTER_LON
+    connection = open_catalog()
+    update_catalog(connection, INPUT_FOLDER, number_of_workers)
+
+    def run():
+        files_with_dates, _ = select_activities(connection, INPUT_FOLDER, (CENTER_LAT - 0.05, CENTER_LAT + 0.05, CENTER_LON - 0.1, CENTER_LON + 0.1))
+        return len(files_with_dates)
+    return run, 'files'
+
+def prepare_bounds(renderer):
+    from configuration import number_of_workers
+    from gpx_files import get_center_and_bounds
+    gpx_files = get_gpx_files()
+
+    def run():
+        get_center_and_bounds(gpx_files, number_of_workers)
+        return len(gpx_files)
+    return run, 'files'
+
+def prepare_map_build(renderer):
+    """The html renderer saves an html map for every frame, the native renderer draws the frames without saving them"""
+    from configuration import MAP_HEIGHT, MAP_WIDTH
+    from gpx_files import get_gpx_filenames_and_dates
+    import workout_map
+    gpx_filenames_with_dates = get_gpx_filenames_and_dates()
+    zoom_level, center_lat, center_lon = get_map_view()
+
+    def run():
+        if renderer == 'html':
+            workout_map.current_directory = os.getcwd()
+            workout_map.create_html_maps(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, range(len(gpx_filenames_with_dates)))
+        else:
+            from output_targets import get_frame_generator
+            generate_frames = get_frame_generator(renderer)
+            for _ in generate_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, MAP_WIDTH, MAP_HEIGHT):
+                pass
+        return len(gpx_filenames_with_dates)
+    return run, 'frames'
+
+def prepare_capture(renderer):
+    """The html renderer captures the html maps with Chrome, the native renderer draws and saves the frames"""
+    from configuration import MAP_HEIGHT, MAP_WIDTH, OUTPUT_FOLDER
+    from gpx_files import get_gpx_filenames_and_dates
+    import workout_map
+    gpx_filenames_with_dates = get_gpx_filenames_and_dates()
+    zoom_level, center_lat, center_lon = get_map_view()
+    frame_indices = list(range(len(gpx_filenames_with_dates)))
+    if renderer == 'html':
+        workout_map.current_directory = os.getcwd()
+        capture_tasks = workout_map.get_capture_tasks(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices)
+
+    def run():
+        if renderer == 'html':
+            workout_map.capture_html_frames(capture_tasks)
+        else:
+            from native_map import render_native_frames
+            from output_targets import get_frame_generator
+            render_native_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, MAP_WIDTH, MAP_HEIGHT, OUTPUT_FOLDER,
+                                 generate_frames=get_frame_generator(renderer))
+        return len(gpx_filenames_with_dates)
+    return run, 'frames'
+
+def prepare_timestamps(renderer):
+    """Stamp and save a map sized frame for every gpx file"""
+    from PIL import Image
+    from configuration import MAP_HEIGHT, MAP_WIDTH, OUTPUT_FOLDER
+    from gpx_files import get_gpx_filenames_and_dates
+    from timestamps import save_stamped_frame
+    gpx_filenames_with_dates = get_gpx_filenames_and_dates()
+    image = Image.new('RGB', (MAP_WIDTH, MAP_HEIGHT), '#dddddd')
+
+    def run():
+        last_frame_index = len(gpx_filenames_with_dates) - 1
+        for frame_index, (_, date) in enumerate(gpx_filenames_with_dates):
+            save_stamped_frame(image, OUTPUT_FOLDER, frame_index, date, frame_index == last_frame_index)
+        return len(gpx_filenames_with_dates)
+    return run, 'frames'
+
+def prepare_warm_cache(renderer):
+    return prepare_dates(renderer)
+
+STAGE_PREPARERS = {
+    'dates': prepare_dates,
+    'catalog': prepare_catalog,
+    'bounds': prepare_bounds,
+    'map_build': prepare_map_build,
+    'capture': prepare_capture,
+    'timestamps': prepare_timestamps,
+    'warm_cache': prepare_warm_cache,
+}
+
+def run_stage(stage, renderer, result_path):
+    """Set the stage up, then time it. The peak memory includes the setup."""
+    run, item_unit = STAGE_PREPARERS[stage](renderer)
+    start_time = time.perf_counter()
+    items = run()
+    wall_time = time.perf_counter() - start_time
+    peak_rss, peak_rss_children = get_peak_rss()
+    result = {'wall_time': wall_time, 'items': items, 'item_unit': item_unit,
+              'peak_rss_bytes': peak_rss, 'peak_rss_children_bytes': peak_rss_children}
+    with open(result_path, 'w', encoding='utf-8') as file:
+        json.dump(result, file)
+
+# The functions below run in the main benchmark process
+
+def create_work_folder(work_folder, corpus_folder, args):
+    """Create an empty work folder with a configuration.py that is the repository's configuration plus the benchmark settings"""
+    shutil.rmtree(work_folder, ignore_errors=True)
+    for folder in ['output', 'html_maps']:
+        os.makedirs(os.path.join(work_folder, folder))
+
+    with open(os.path.join(REPOSITORY_FOLDER, 'configuration.py'), 'r', encoding='utf-8') as file:
+        configuration = file.read()
+    overrides = {
+        'INPUT_FOLDER': corpus_folder,
+        'OUTPUT_FOLDER': os.path.join(work_folder, 'output'),
+        'GPX_CACHE': args.cache != 'off',
+        'GPX_CACHE_FOLDER': os.path.join(work_folder, 'gpx_cache'),
+        'ACTIVITY_CATALOG': os.path.join(work_folder, 'activities.sqlite'),
+        # Never requested, as the stub tiles are in place before the stages look for tiles
+        'TILE_SERVER_URL': 'http://127.0.0.1:9/{z}/{x}/{y}.png',
+        # The stub tiles are loose files
+        'TILE_STORE': None,
+        'VERBOSE_OUTPUT': False,
+        'MAP_WIDTH': args.width,
+        'MAP_HEIGHT': args.height,
+    }
+    if args.workers:
+        overrides['number_of_workers'] = args.workers
+    configuration += '\n\n# Benchmark settings\n' + ''.join(f'{name} = {value!r}\n' for name, value in overrides.items())
+    with open(os.path.join(work_folder, 'configuration.py'), 'w', encoding='utf-8') as file:
+        file.write(configuration)
+
+def run_stage_process(work_folder, stage, renderer):
+    """Run a stage in a new process in the work folder. Returns its result, with the error instead if it failed."""
+    result_path = os.path.join(work_folder, f'result_{stage}.json')
+    if os.path.exists(result_path):
+        os.unlink(result_path)
+    # The work folder comes first on the path, so the program modules import its configuration.py
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([work_folder, REPOSITORY_FOLDER]))
+    command = [sys.executable, '-m', 'benchmarks.stage_benchmarks', '--run-stage', stage, '--renderer', renderer, '--result', result_path]
+    process = subprocess.run(command, cwd=work_folder, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0 or not os.path.exists(result_path):
+        error_lines = process.stderr.strip().splitlines()
+        return {'error': error_lines[-1] if error_lines else f'exit code {process.returncode}'}
+    with open(result_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def print_result(result):
+    if 'error' in result:
+        print(f'{result["files"]:>6} files  {result["stage"]:<11} failed: {result["error"]}')
+        return
+    peak_rss = result['peak_rss_bytes']
+    memory = f'{peak_rss / 1e6:8.1f} MB peak' if peak_rss is not None else ''
+    print(f'{result["files"]:>6} files  {result["stage"]:<11} {result["wall_time"]:8.2f} s  '
+          f'{result["items_per_second"]:9.1f} {result["item_unit"]}/s  {memory}')
+
+def main(args):
+    data_folder = os.path.abspath(args.data_folder)
+    results = []
+    for file_count in args.files:
+        corpus_name = f'corpus_{file_count}_{args.points}_{args.segments}_{args.spread}_{args.seed}'
+        corpus_folder = os.path.join(data_folder, corpus_name)
+        print(f'Generating {file_count} gpx files into {corpus_folder}')
+        generate_corpus(corpus_folder, file_count, args.points, args.segments, args.spread, args.seed)
+
+        work_folder = os.path.join(data_folder, f'work_{file_count}')
+        create_work_folder(work_folder, corpus_folder, args)
+        if args.cache == 'warm':
+            run_stage_process(work_folder, 'warm_cache', args.renderer)
+
+        for stage in args.stages:
+            if args.cache == 'cold':
+                shutil.rmtree(os.path.join(work_folder, 'gpx_cache'), ignore_errors=True)
+            result = {'files': file_count, 'stage': stage}
+            result.update(run_stage_process(work_folder, stage, args.renderer))
+            if 'error' not in result:
+                result['items_per_second'] = result['items'] / result['wall_time'] if result['wall_time'] > 0 else None
+            results.append(result)
+            print_result(result)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {'points_per_file': args.points, 'segments': args.segments, 'spread': args.spread, 'seed': args.seed,
+                       'renderer': args.renderer, 'cache': args.cache, 'map_size': [args.width, args.height], 'workers': args.workers},
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=1)
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the timelapse creator on synthetic gpx files.')
+    parser.add_argument('--files', type=int, nargs='+', default=[100], help='gpx file counts to benchmark, e.g. 100 1000 10000')
+    parser.add_argument('--points', type=int, default=1000, help='points per gpx file')
+    parser.add_argument('--segments', type=int, default=1, help='track segments per gpx file')
+    parser.add_argument('--spread', type=float, default=0.2, help='spread of the routes in degrees of latitude (twice that in longitude)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--renderer', choices=['html', 'native', 'heatmap'], default='native')
+    parser.add_argument('--cache', choices=['warm', 'cold', 'off'], default='warm',
+                        help='warm: parsed gpx files are cached before the stages, cold: the cache is emptied before each stage, off: no cache')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--workers', type=int, default=None, help='number of workers, the configured number by default')
+    parser.add_argument('--data-folder', default=os.path.join(tempfile.gettempdir(), 'gpx_timelapse_benchmarks'),
+                        help='folder for the generated gpx files and the work folders')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--run-stage', choices=list(STAGE_PREPARERS), help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_stage:
+        run_stage(args.run_stage, args.renderer, args.result)
+    else:
+        main(args)
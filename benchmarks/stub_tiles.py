@@ -0,0 +1,34 @@
+# Stub map tiles for the benchmarks, so that nothing is downloaded
+
+import io
+import os
+
+from PIL import Image, ImageDraw
+
+TILE_SIZE = 256
+
+
+def create_stub_tile():
+    """Get the png data of a plain tile with a grid line on its top and left edges"""
+    image = Image.new('RGB', (TILE_SIZE, TILE_SIZE), '#e8e4d8')
+    draw = ImageDraw.Draw(image)
+    draw.line([(0, TILE_SIZE - 1), (0, 0), (TILE_SIZE - 1, 0)], fill='#b0a890')
+    data = io.BytesIO()
+    image.save(data, 'PNG')
+    return data.getvalue()
+
+def write_stub_tiles(tile_folder, zoom, min_x, max_x, min_y, max_y):
+    """Write a stub tile for every tile in the range that doesn't exist yet. Returns the number of tiles written."""
+    tile_data = create_stub_tile()
+    tile_count = 2 ** zoom
+    written = 0
+    for x in range(min_x, max_x + 1):
+        for y in range(max(min_y, 0), min(max_y, tile_count - 1) + 1):
+            tile_path = os.path.join(tile_folder, str(zoom), str(x), f'{y}.png')
+            if os.path.exists(tile_path):
+                continue
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            with open(tile_path, 'wb') as file:
+                file.write(tile_data)
+            written += 1
+    return written
@@ -0,0 +1,84 @@
+# Deterministic synthetic gpx corpus for the benchmarks.
+# Usage: python -m benchmarks.synthetic_gpx folder [--files 100] [--points 1000] [--segments 1] [--spread 0.2] [--seed 0]
+
+import argparse
+import json
+import math
+import os
+import random
+from datetime import datetime, timedelta
+
+CENTER_LAT = 60.17
+CENTER_LON = 24.94
+START_DATE = datetime(2018, 1, 1)
+# Activities start this many hours apart, so 10k files span about nine years of YEAR_COLORS
+HOURS_BETWEEN_FILES = 8
+# About 10 meters per point
+STEP_DEGREES = 0.0001
+
+
+def write_gpx_file(file_path, rng, start_lat, start_lon, start_time, point_count, segment_count):
+    """Write a random walk with a slowly turning heading, point_count points split into segment_count segments, one point per second"""
+    lat = start_lat
+    lon = start_lon
+    heading = rng.uniform(0, 2 * math.pi)
+    point_time = start_time
+    segment_count = max(1, min(segment_count, point_count))
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        file.write('<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        file.write(f'<metadata><time>{start_time:%Y-%m-%dT%H:%M:%SZ}</time></metadata>\n<trk>\n')
+        for segment in range(segment_count):
+            file.write('<trkseg>\n')
+            segment_points = point_count // segment_count + (1 if segment < point_count % segment_count else 0)
+            for _ in range(segment_points):
+                heading += rng.gauss(0, 0.1)
+                lat += STEP_DEGREES * math.cos(heading)
+                # A degree of longitude is about half as long as a degree of latitude this far north
+                lon += STEP_DEGREES * 2 * math.sin(heading)
+                file.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{rng.uniform(0, 50):.1f}</ele>'
+                           f'<time>{point_time:%Y-%m-%dT%H:%M:%SZ}</time></trkpt>\n')
+                point_time += timedelta(seconds=1)
+            file.write('</trkseg>\n')
+        file.write('</trk>\n</gpx>\n')
+
+def generate_corpus(folder, file_count, points_per_file, segment_count=1, spread=0.2, seed=0):
+    """Write file_count gpx files whose routes start at random within spread degrees around the center.
+    The same parameters always give the same files. An existing corpus with the same parameters is left as it is.
+    Returns the paths of the files."""
+    parameters = {'files': file_count, 'points': points_per_file, 'segments': segment_count, 'spread': spread, 'seed': seed}
+    parameters_path = os.path.join(folder, 'corpus.json')
+    file_paths = [os.path.join(folder, f'activity_{index:05d}.gpx') for index in range(file_count)]
+    try:
+        with open(parameters_path, 'r', encoding='utf-8') as file:
+            if json.load(file) == parameters and all(os.path.exists(file_path) for file_path in file_paths):
+                return file_paths
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(folder, exist_ok=True)
+    for filename in os.listdir(folder):
+        if filename.endswith('.gpx'):
+            os.unlink(os.path.join(folder, filename))
+    for index, file_path in enumerate(file_paths):
+        # Seeding each file on its own keeps a file the same whatever the file count is
+        rng = random.Random(f'{seed}-{index}')
+        start_lat = CENTER_LAT + rng.uniform(-spread / 2, spread / 2)
+        start_lon = CENTER_LON + rng.uniform(-spread, spread)
+        start_time = START_DATE + timedelta(hours=HOURS_BETWEEN_FILES * index)
+        write_gpx_file(file_path, rng, start_lat, start_lon, start_time, points_per_file, segment_count)
+    with open(parameters_path, 'w', encoding='utf-8') as file:
+        json.dump(parameters, file)
+    return file_paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a deterministic synthetic gpx corpus.')
+    parser.add_argument('folder')
+    parser.add_argument('--files', type=int, default=100, help='number of gpx files')
+    parser.add_argument('--points', type=int, default=1000, help='points per file')
+    parser.add_argument('--segments', type=int, default=1, help='track segments per file')
+    parser.add_argument('--spread', type=float, default=0.2, help='spread of the route start points in degrees of latitude (twice that in longitude)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    file_paths = generate_corpus(args.folder, args.files, args.points, args.segments, args.spread, args.seed)
+    print(f'{len(file_paths)} gpx files in {args.folder}')
@@ -0,0 +1,316 @@
+# Functions related to capturing the html maps with a pool of long-lived browser workers
+
+import bisect
+import io
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from PIL import Image
+from selenium import webdriver
+
+from configuration import *
+from image_files import print_wait_times, set_chrome_options, wait_for_map_ready
+from instrumentation import add_queue_wait, instrumented
+from timestamps import save_stamped_frame
+from util import create_progress_bar_string
+
+# Seconds between checks on the workers while waiting for their messages
+POLL_INTERVAL = 0.5
+# Seconds a worker gets to quit its browser and exit when it's stopped, before it's killed
+STOP_TIMEOUT = 5
+
+
+@instrumented('capture')
+def capture_task(driver, task, loaded_page, stream, queued_at):
+    """Capture the frame of a task with the driver. Returns the png data when streaming, the time waited for the map to be ready
+    in milliseconds and the page left loaded in the browser."""
+    # The time between queueing the frame and starting on it
+    add_queue_wait(time.time() - queued_at)
+    frame_index, html_path, date, last_frame_index, single_page, output_folder = task
+    if not single_page or loaded_page != html_path:
+        driver.get(f'file://{os.path.abspath(html_path)}')
+        loaded_page = html_path
+    if single_page:
+        driver.execute_script('showTracks(arguments[0]);', frame_index + 1)
+    waited_ms = wait_for_map_ready(driver)
+    image_capture_data = driver.get_screenshot_as_png()
+    if stream:
+        return image_capture_data, waited_ms, loaded_page
+    # Stamp the image while it's in memory and write it into the output folder
+    image = Image.open(io.BytesIO(image_capture_data))
+    save_stamped_frame(image, output_folder, frame_index, date, is_last_frame=frame_index == last_frame_index)
+    return None, waited_ms, loaded_page
+
+def is_browser_alive(driver):
+    try:
+        driver.execute_script('return 1;')
+        return True
+    except Exception:
+        return False
+
+def capture_worker(worker_id, task_queue, result_queue, stream):
+    """Start a browser and capture frames from the worker's task queue until it sends None.
+    The queue sends (task, time it was queued). Every task is reported on the result queue as started, then done or failed. Exits if the browser stops responding."""
+    # Ctrl+C is handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(os, 'setsid'):
+        # The browser driver and the browser processes it starts share the worker's process group, so they can be killed together
+        os.setsid()
+    try:
+        driver = webdriver.Chrome(options=set_chrome_options())
+    except Exception as e:
+        result_queue.put(('error', worker_id, f'Could not start the browser: {e}'))
+        return
+    try:
+        result_queue.put(('ready', worker_id, driver.service.process.pid))
+        loaded_page = None
+        while True:
+            queued_task = task_queue.get()
+            if queued_task is None:
+                break
+            task, queued_at = queued_task
+            result_queue.put(('started', worker_id, task[0]))
+            start_time = time.perf_counter()
+            try:
+                image_capture_data, waited_ms, loaded_page = capture_task(driver, task, loaded_page, stream, queued_at)
+            except Exception as e:
+                result_queue.put(('failed', worker_id, task[0], str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__))
+                # The page may be left in any state, so it's loaded again for the next frame
+                loaded_page = None
+                if not is_browser_alive(driver):
+                    return
+                continue
+            result_queue.put(('done', worker_id, task[0], image_capture_data, waited_ms, time.perf_counter() - start_time))
+    finally:
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+
+class CaptureWorker:
+    """A capture worker process as seen by the scheduler, with its statistics over restarts.
+    The worker has a task queue of its own, so the scheduler knows which frame it was given even if it stops before starting on it."""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.task_queue = None
+        self.browser_pid = None
+        self.task = None
+        self.task_start = None
+        self.process_start = None
+        self.ready = False
+        self.restarts = 0
+        self.frames = 0
+        self.failures = 0
+        self.busy_time = 0
+
+    def start(self, result_queue, stream):
+        # A new queue, so a frame left in the queue of a stopped worker isn't captured twice
+        self.task_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=capture_worker, args=(self.worker_id, self.task_queue, result_queue, stream),
+                                               daemon=True)
+        self.process.start()
+        self.process_start = time.monotonic()
+        self.browser_pid = None
+        self.task = None
+        self.ready = False
+
+    def give_task(self, task):
+        self.task = task
+        self.task_start = time.monotonic()
+        self.task_queue.put((task, time.time()))
+
+    def is_hung(self):
+        """Stuck on a frame, or starting the browser, for longer than CAPTURE_HANG_TIMEOUT"""
+        since = self.process_start if not self.ready else (self.task_start if self.task is not None else None)
+        return since is not None and time.monotonic() - since > CAPTURE_HANG_TIMEOUT
+
+    def stop(self):
+        """Ask the worker to quit its browser and exit, and kill it if it doesn't in STOP_TIMEOUT seconds, e.g. when it's stuck on a frame.
+        Killing a worker while it's sending a message could break the result queue, so it's only done to workers that don't exit.
+        The browser processes left over are killed either way."""
+        if self.process.is_alive():
+            self.task_queue.put(None)
+            self.process.join(STOP_TIMEOUT)
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except OSError:
+                # No processes left in the group, or the worker stopped before starting a group of its own
+                pass
+        elif self.browser_pid is not None:
+            try:
+                os.kill(self.browser_pid, signal.SIGTERM)
+            except OSError:
+                pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        # Anything left in the queue is dropped
+        self.task_queue.cancel_join_thread()
+
+
+class CaptureScheduler:
+    """Hands out frames to the capture workers in order and collects the results.
+
+    At most REORDER_BUFFER_FRAMES frames past the first unfinished frame are handed out, so the frames captured
+    ahead of a slow frame stay bounded. A frame is only handed to a worker that is free to take it, so the frame
+    of a crashed worker goes back to the front of the line instead of behind the handed out ones."""
+
+    def __init__(self, tasks, stream):
+        self.stream = stream
+        self.pending = list(tasks)
+        self.task_count = len(self.pending)
+        self.frame_order = [task[0] for task in self.pending]
+        self.attempts = {}
+        self.results = {}
+        self.wait_times = []
+        self.result_queue = multiprocessing.Queue()
+        self.workers = [CaptureWorker(worker_id) for worker_id in range(min(number_of_workers, self.task_count))]
+        self.restarts_left = 2 * len(self.workers)
+        self.start_time = time.monotonic()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start(self.result_queue, self.stream)
+
+    def get_live_workers(self):
+        return [worker for worker in self.workers if worker.process is not None]
+
+    def feed_tasks(self, next_position):
+        """Hand pending frames to the free workers, as long as they're close enough to the next frame in order"""
+        limit = self.frame_order[next_position] + REORDER_BUFFER_FRAMES if next_position < self.task_count else None
+        for worker in self.get_live_workers():
+            if not self.pending or (limit is not None and self.pending[0][0] >= limit):
+                break
+            if worker.task is None:
+                worker.give_task(self.pending.pop(0))
+
+    def retry(self, task, reason):
+        """Put a frame back in line, or give up on it after CAPTURE_RETRIES retries"""
+        frame_index = task[0]
+        self.attempts[frame_index] = self.attempts.get(frame_index, 0) + 1
+        if self.attempts[frame_index] > CAPTURE_RETRIES:
+            print(f'\rError capturing frame {frame_index}: {reason}')
+            self.results[frame_index] = None
+        else:
+            if VERBOSE_OUTPUT:
+                print(f'\rRetrying frame {frame_index}: {reason}')
+            bisect.insort(self.pending, task)
+
+    def restart(self, worker, reason):
+        """Replace a crashed or hung worker, retrying its frame. The worker is left stopped if there have been too many restarts."""
+        print(f'\rCapture worker {worker.worker_id} {reason}.')
+        worker.stop()
+        if worker.task is not None:
+            self.retry(worker.task, reason)
+        if self.restarts_left > 0:
+            self.restarts_left -= 1
+            worker.restarts += 1
+            worker.start(self.result_queue, self.stream)
+        else:
+            worker.process = None
+            worker.task = None
+
+    def handle_message(self, message):
+        kind, worker_id = message[:2]
+        worker = self.workers[worker_id]
+        if kind == 'ready':
+            worker.ready = True
+            worker.browser_pid = message[2]
+        elif kind == 'started':
+            # The hang timeout starts over, as a worker still starting its browser can't take the frame right away
+            worker.task_start = time.monotonic()
+        elif kind == 'done':
+            image_capture_data, waited_ms, capture_time = message[3:]
+            self.results[message[2]] = image_capture_data if self.stream else True
+            self.wait_times.append(waited_ms)
+            worker.frames += 1
+            worker.busy_time += capture_time
+            worker.task = None
+        elif kind == 'failed' and worker.task is not None:
+            worker.failures += 1
+            self.retry(worker.task, message[3])
+            worker.task = None
+        elif kind == 'error':
+            print(f'\rCapture worker {worker_id}: {message[2]}')
+
+    def check_workers(self):
+        # The messages a worker sent before it stopped are handled first, so its finished frames aren't retried
+        while True:
+            try:
+                self.handle_message(self.result_queue.get_nowait())
+            except queue.Empty:
+                break
+        for worker in self.get_live_workers():
+            if not worker.process.is_alive():
+                self.restart(worker, f'stopped (exit code {worker.process.exitcode})')
+            elif worker.is_hung():
+                self.restart(worker, f'did not respond in {CAPTURE_HANG_TIMEOUT} seconds')
+
+    def run(self):
+        """Yield (frame index, result) for the frames in order as soon as each frame is ready. The result is the png data when
+        streaming, otherwise True once the worker has saved the frame. It is None for frames that could not be captured."""
+        self.start()
+        last_check = time.monotonic()
+        try:
+            for position, frame_index in enumerate(self.frame_order):
+                while frame_index not in self.results:
+                    if not self.get_live_workers():
+                        # Without workers, nothing more can be captured
+                        print(f'\rNo capture workers left, {self.task_count - position} frames were not captured.')
+                        for task in self.pending:
+                            self.results.setdefault(task[0], None)
+                        self.pending = []
+                        self.results.setdefault(frame_index, None)
+                        break
+                    self.feed_tasks(position)
+                    try:
+                        self.handle_message(self.result_queue.get(timeout=POLL_INTERVAL))
+                    except queue.Empty:
+                        pass
+                    if time.monotonic() - last_check > POLL_INTERVAL:
+                        self.check_workers()
+                        last_check = time.monotonic()
+                yield frame_index, self.results.pop(frame_index)
+        finally:
+            self.stop()
+
+    def stop(self):
+        # Frames still queued when the capture is stopped early are dropped, see CaptureWorker.stop
+        for worker in self.get_live_workers():
+            worker.task_queue.put(None)
+        for worker in self.get_live_workers():
+            worker.stop()
+
+    def print_worker_stats(self):
+        elapsed = time.monotonic() - self.start_time
+        for worker in self.workers:
+            fps = worker.frames / elapsed if elapsed else 0
+            restarts = f', {worker.restarts} restarts' if worker.restarts else ''
+            failures = f', {worker.failures} failed' if worker.failures else ''
+            print(f'Worker {worker.worker_id}: {worker.frames} frames, {fps:.2f} fps '
+                  f'({worker.busy_time / max(1, worker.frames):.2f} s per frame){failures}{restarts}')
+        print_wait_times(self.wait_times)
+
+
+def capture_frames(tasks, stream=False):
+    """Capture the tasks with a pool of browser workers and yield (frame index, result) in order, see CaptureScheduler.run.
+    A task is (frame index, html path, date, last frame index, single page, output folder), where single page means the html path
+    is the single page map and the frame is shown on it with showTracks. Unless streaming, the frame is saved in the output folder."""
+    scheduler = CaptureScheduler(tasks, stream)
+    yield from scheduler.run()
+    scheduler.print_worker_stats()
+
+def capture_html_frames(tasks):
+    """Capture the html maps into images in the output folders of the tasks, stamped with the dates while they're still in memory"""
+    print('Capturing html maps into images.')
+    for position, (frame_index, result) in enumerate(capture_frames(tasks)):
+        progress_bar = create_progress_bar_string(position + 1, len(tasks))
+        print(f'\r{progress_bar} {position + 1} / {len(tasks)}       ', end='', flush=True)
+    print('\r                                                                                                 \r')
@@ -1,58 +1,172 @@
-import multiprocessing
-
-# Configuration
-MAP_WIDTH = 1920
-MAP_HEIGHT = 1080
-INPUT_FOLDER = 'input'
-OUTPUT_FOLDER = 'output'
-
-# Stamp the current date and year color legend in the output images.
-TIMESTAMPS = True
-
-# Define colors that represent years.
-# Black (#000000) is used for years that have no color defined.
-# Only defined years/colors will be included on the legend.
-# Put these in chronological order.
-YEAR_COLORS = {
-    2018: '#000000',
-    2019: '#0000FF',
-    2020: '#6600BB',
-    2021: '#FF0000',
-    2022: '#00AA00',
-    2023: '#888800',
-    2024: '#FF88FF'
-}
-
-# GPX files are sorted by date by default - but can sorted by name too.
-SORT_BY_NAME = False
-
-# Use False for default map tiles, or True for better-looking 'Alidade Smooth' map tiles. The latter requires a Stadia API key, but you can get one for free.
-ALIDADE_MAP = False
-STADIA_API_KEY = 'your stadia API key here'
-EXTRA_MAP_TILES = 5
-
-# The map zoom level is detected based on the lat/lon coordinates in routes.
-# By default (0), all routes are completely visible on the map.
-# Add positive values to zoom in or negative values to zoom out. 
-ADDITIONAL_ZOOM_LEVELS = 1
-
-# Map boundaries are based on the lat/lon coordinates in routes.
-# You can adjust the autodetected view position with these values
-ADJUST_BOUNDARIES = False
-MIN_LAT_ADJUSTMENT = 0.00
-MAX_LAT_ADJUSTMENT = -0.00
-MIN_LON_ADJUSTMENT = 0.00
-MAX_LON_ADJUSTMENT = -0.00
-
-# More output text, for debugging purposes
-VERBOSE_OUTPUT = False
-
-# Seconds to wait between loading the html and capturing it. It takes some time for the tiles to load and the map to adjust itself into position.
-# Increase this value if your map images have not fully loaded / adjusted into position.
-CAPTURE_DELAY = 0.6
-
-# If True, deletes all files in the output folder before proceeding
-CLEAR_OUTPUT_FOLDER = True
-
-# This script uses (logical processors - 1) workers for multithreading. Set a custom value if desired.
-number_of_workers = max(1, multiprocessing.cpu_count() - 1)
+import multiprocessing
+
+# Configuration
+MAP_WIDTH = 1920
+MAP_HEIGHT = 1080
+INPUT_FOLDER = 'input'
+OUTPUT_FOLDER = 'output'
+
+# Stamp the current date and year color legend in the output images.
+TIMESTAMPS = True
+
+# Define colors that represent years.
+# Black (#000000) is used for years that have no color defined.
+# Only defined years/colors will be included on the legend.
+# Put these in chronological order.
+YEAR_COLORS = {
+    2018: '#000000',
+    2019: '#0000FF',
+    2020: '#6600BB',
+    2021: '#FF0000',
+    2022: '#00AA00',
+    2023: '#888800',
+    2024: '#FF88FF'
+}
+
+# 'html' creates folium html maps and captures them with Chrome (Selenium).
+# 'native' draws the routes directly onto the downloaded map tiles - much faster, and Chrome is not needed.
+# 'heatmap' colors the map tiles by how many activities pass through each pixel, so popular routes stay readable.
+# Can also be chosen on the command line with --renderer native
+RENDERER = 'html'
+
+# With the heatmap renderer: number of activities at which a pixel gets the last of HEATMAP_COLORS.
+# The fixed number keeps the colors of a pixel the same from frame to frame.
+HEATMAP_SATURATION = 50
+# Colors from one activity to HEATMAP_SATURATION activities
+HEATMAP_COLORS = ['#3b0f70', '#b5367a', '#fb8761', '#fcfdbf']
+# If True, pixels are colored with the mix of the YEAR_COLORS of the activities through them instead, brighter with more activities
+HEATMAP_YEAR_COLORS = False
+
+# With the html renderer: if True, all routes are loaded into one html map, and Chrome reveals them frame by frame with JavaScript.
+# This avoids saving and reloading an ever growing html map for every frame.
+SINGLE_PAGE_MAP = False
+
+# GPX files are sorted by date by default - but can sorted by name too.
+SORT_BY_NAME = False
+
+# Use False for default map tiles, or True for better-looking 'Alidade Smooth' map tiles. The latter requires a Stadia API key, but you can get one for free.
+ALIDADE_MAP = False
+STADIA_API_KEY = 'your stadia API key here'
+EXTRA_MAP_TILES = 5
+
+# Failed tile downloads (HTTP 429/5xx or connection errors) are retried this many times with increasing delays.
+TILE_DOWNLOAD_RETRIES = 4
+TILE_RETRY_BASE_DELAY = 1.0
+
+# Custom tile server url such as 'http://localhost:8080/{z}/{x}/{y}.png', e.g. for a local tile server. None uses the default tile providers.
+TILE_SERVER_URL = None
+
+# Downloaded map tiles are kept in this SQLite file between runs, and only missing tiles and tiles older than
+# TILE_MAX_AGE_DAYS are downloaded again. The least recently used tiles are removed when it grows beyond TILE_STORE_MAX_MB.
+# The native and heatmap renderers also keep the decoded map image of each view in TILE_MOSAIC_FOLDER, so runs with
+# the same view don't decode the tiles again. None keeps the tiles as png files in html_maps/map_tiles only.
+TILE_STORE = 'tiles.sqlite'
+TILE_MAX_AGE_DAYS = 30
+TILE_STORE_MAX_MB = 1000
+TILE_MOSAIC_FOLDER = 'mosaic_cache'
+
+# The map zoom level is detected based on the lat/lon coordinates in routes.
+# By default (0), all routes are completely visible on the map.
+# Add positive values to zoom in or negative values to zoom out. 
+ADDITIONAL_ZOOM_LEVELS = 1
+
+# If True, the zoom level is fractional so that the routes fill the map exactly (before ADDITIONAL_ZOOM_LEVELS).
+# Map tiles are then scaled from the nearest whole zoom level.
+FRACTIONAL_ZOOM = False
+
+# Routes are simplified before drawing: points that would change the drawn line by less than this many pixels are dropped.
+# Set to 0 to draw every point.
+SIMPLIFY_TOLERANCE = 0.5
+
+# Map boundaries are based on the lat/lon coordinates in routes.
+# You can adjust the autodetected view position with these values
+ADJUST_BOUNDARIES = False
+MIN_LAT_ADJUSTMENT = 0.00
+MAX_LAT_ADJUSTMENT = -0.00
+MIN_LON_ADJUSTMENT = 0.00
+MAX_LON_ADJUSTMENT = -0.00
+# Leave this percentage of the lowest and highest latitudes and longitudes of all points out of the map bounds and center,
+# e.g. 0.01 so that a few GPS glitches far away from the routes don't zoom the map out. 0 uses all points.
+BOUNDS_OUTLIER_PERCENT = 0
+
+# Parsed gpx files are cached as NumPy arrays in this folder, so re-runs don't have to parse the XML again.
+# Changed files are detected automatically.
+GPX_CACHE = True
+GPX_CACHE_FOLDER = 'gpx_cache'
+
+# The start time, bounding box, point count and fingerprint of every gpx file are kept in this SQLite catalog,
+# which is updated with just the new and changed files on each run. None reads the dates of all files every run.
+ACTIVITY_CATALOG = 'activities.sqlite'
+# With the catalog, render only the activities whose routes are in the area (min_lat, max_lat, min_lon, max_lon),
+# e.g. (60.1, 60.3, 24.8, 25.2), and that start between the dates, e.g. '2023-01-01' (the end date is not included).
+# None selects everything. Can also be set with --bbox, --start and --end
+SELECT_BOUNDS = None
+SELECT_START_DATE = None
+SELECT_END_DATE = None
+
+# More output text, for debugging purposes
+VERBOSE_OUTPUT = False
+
+# Before each capture, the html map is watched until its tiles have loaded and it has moved into position.
+# Maximum number of seconds to wait for that - the map is captured anyway after this.
+CAPTURE_TIMEOUT = 10
+# A capture worker whose browser crashes, or that is stuck on one frame for this many seconds, is restarted
+CAPTURE_HANG_TIMEOUT = 60
+# Number of times a frame that fails to capture is tried again before it's skipped
+CAPTURE_RETRIES = 2
+
+# Write the timelapse straight into this video file in the output folder, e.g. 'timelapse.mp4'.
+# Requires ffmpeg (FFMPEG_PATH if it's not on the PATH). None writes just the images, to be made into a video afterwards.
+OUTPUT_VIDEO = None
+FFMPEG_PATH = 'ffmpeg'
+VIDEO_FPS = 60
+# Seconds each route is shown in the video, and how long the final image is held
+FRAME_DURATION = 0.25
+LAST_FRAME_DURATION = 3
+# With OUTPUT_VIDEO and the native or heatmap renderer, draw each route over this many video frames instead of all at once.
+# The parts share the route's FRAME_DURATION, so up to FRAME_DURATION * VIDEO_FPS makes sense. 1 shows each route at once.
+# Frames reused with --resume are shown without the animation.
+ROUTE_ANIMATION_FRAMES = 1
+# If True, the routes are drawn at the pace of their gpx timestamps, otherwise at an even speed
+ROUTE_ANIMATION_TIMED = False
+# With OUTPUT_VIDEO, also write the images into the output folder
+WRITE_PNG_FILES = True
+
+# Render several outputs of the same routes in one run, each into a folder of its name in the output folder, e.g.
+# [{'name': '1080p', 'size': (1920, 1080)},
+#  {'name': '4k', 'size': (3840, 2160), 'zoom_offset': 1},
+#  {'name': 'vertical', 'size': (1080, 1920), 'crop': (60.1, 60.3, 24.8, 25.2)}]
+# zoom_offset is added to the zoom level the target's size gets, and crop is an area (min_lat, max_lat, min_lon, max_lon)
+# the target is centered on and zoomed to fit instead of all routes. The gpx files, map bounds and map tiles are shared,
+# and only the drawing and the video of each target are done separately, in parallel.
+# Needs the native or heatmap renderer. An empty list renders one MAP_WIDTH x MAP_HEIGHT output into the output folder.
+OUTPUT_TARGETS = []
+# With the html renderer, capture workers are given frames at most this many frames ahead of the first unfinished frame,
+# so the frames waiting to be written in order stay bounded
+REORDER_BUFFER_FRAMES = 32
+
+# With --shards N, the frames are split into N shards of consecutive frames, each rendered by a process of its own starting
+# from a keyframe of the map at its first frame, and the shards are merged into the output folder in order.
+# The job, keyframes and frames of the shards are kept in this folder until they're merged. With --plan-only, the shards
+# can be run on other machines that share the folder and have the same gpx files and configuration, see README.md.
+# Each shard uses number_of_workers capture workers with the html renderer, and routes are not drawn in parts (ROUTE_ANIMATION_FRAMES).
+RENDER_JOB_FOLDER = 'render_job'
+
+# If True, deletes all files in the output folder before proceeding
+CLEAR_OUTPUT_FOLDER = True
+
+# If True, frames of the previous run are kept up to the first new or changed gpx file (by date), and only the rest are rendered.
+# An interrupted run also continues from where it stopped. Uses output/manifest.json, which every run writes. Can also be set with --resume
+RESUME = False
+
+# Write run_report.json and run_report.csv into the output folder, with the time each stage of the run took, latency
+# histograms and worker utilization of the work items, bytes read and written and peak memory. Can also be set with --report
+RUN_REPORT = False
+# Stages or work items to profile with cProfile, written next to the report. View them with e.g. python -m pstats.
+# Stages: catalog, bounds, tiles, dates, manifest, html_maps, capture, native_render, video, targets, keyframes, shards, merge
+# Work items: parse, tile_download, html_save, capture, draw, timestamp, png_write
+# e.g. ['capture'], or on the command line --profile capture
+PROFILE_STAGES = []
+
+# This script uses (logical processors - 1) workers for multithreading. Set a custom value if desired.
+number_of_workers = max(1, multiprocessing.cpu_count() - 1)
@@ -0,0 +1,137 @@
+# Functions related to creating folium html maps
+
+import json
+
+import folium
+import numpy as np
+from folium import TileLayer
+
+from configuration import *
+from gpx_files import get_segment_arrays_from_gpx
+from simplify import print_simplification, simplify_route
+
+COORDINATE_SCALE = 100000  # Coordinates are stored as integer deltas of 1e-5 degrees (about one metre) in the single page map
+
+
+READINESS_SCRIPT = '''
+    // Keeps track of tile loading and map movement, so the capture can start as soon as the map is ready.
+    // Registered as an init hook, because this script runs before the map and its tile layers are created.
+    var gpxMapState = {map: null, moving: false};
+
+    L.Map.addInitHook(function () {
+        var map = this;
+        gpxMapState.map = map;
+        map.on('movestart zoomstart', function () { gpxMapState.moving = true; });
+        map.on('moveend zoomend', function () { gpxMapState.moving = false; });
+        map.on('layeradd', function (event) {
+            var layer = event.layer;
+            if (!(layer instanceof L.GridLayer)) {
+                return;
+            }
+            // The layer has usually started loading its tiles already while it was being added
+            layer.gpxLoaded = !layer._loading;
+            layer.on('loading', function () { layer.gpxLoaded = false; });
+            layer.on('load', function () { layer.gpxLoaded = true; });
+        });
+    });
+
+    function gpxPendingTiles() {
+        var pending = 0;
+        document.querySelectorAll('img.leaflet-tile').forEach(function (tile) {
+            if (!tile.complete) {
+                pending++;
+            }
+        });
+        return pending;
+    }
+
+    function gpxMapReady() {
+        var map = gpxMapState.map;
+        if (map === null || !map._loaded || gpxMapState.moving || map._animatingZoom) {
+            return false;
+        }
+        var loaded = true;
+        map.eachLayer(function (layer) {
+            if (layer instanceof L.GridLayer && !layer.gpxLoaded) {
+                loaded = false;
+            }
+        });
+        return loaded && gpxPendingTiles() === 0;
+    }
+    '''
+
+
+def create_folium_map(center_lat, center_lon, zoom_level):
+    # Animations are disabled, so a map that has finished loading is also fully drawn
+    options = {'fade_animation': False, 'zoom_animation': False}
+    if zoom_level != int(zoom_level):
+        options['zoom_snap'] = 0  # Allow fractional zoom levels
+    folium_map = folium.Map(location=[center_lat, center_lon], zoom_start=zoom_level, **options)
+    # folium_map.fit_bounds([[min_lat, min_lon], [max_lat, max_lon]])
+
+    if ALIDADE_MAP:
+        TileLayer(
+            tiles="map_tiles/{z}/{x}/{y}.png",
+            attr="&copy; <a href='https://stadiamaps.com/'>Stadia Maps</a>, &copy; <a href='https://openmaptiles.org/'>OpenMapTiles</a> &copy; <a href='http://openstreetmap.org/copyright'>OpenStreetMap contributors</a>",
+            name='Alidade Smooth',
+            control=False
+        ).add_to(folium_map)
+
+    folium_map.get_root().script.add_child(folium.Element(READINESS_SCRIPT))
+    return folium_map
+
+def encode_segment(latitudes, longitudes):
+    """Encode a segment as a flat list of integer lat/lon deltas"""
+    scaled = np.empty((len(latitudes), 2), dtype=np.int64)
+    scaled[:, 0] = np.round(np.asarray(latitudes) * COORDINATE_SCALE)
+    scaled[:, 1] = np.round(np.asarray(longitudes) * COORDINATE_SCALE)
+    return np.diff(scaled, axis=0, prepend=0).ravel().tolist()
+
+def add_single_page_tracks(folium_map, gpx_filenames_with_dates, zoom_level):
+    """Embed all routes in the map as compact data, along with a showTracks(count) function that draws the first count routes.
+
+    Routes already on the map are not redrawn, so frames can be advanced in order without reloading the page.
+    Going back to an earlier frame removes the later routes."""
+    colors = []
+    tracks = []
+    total_points_in = 0
+    total_points_out = 0
+    for file_path, date in gpx_filenames_with_dates:
+        color = YEAR_COLORS.get(date.year, '#000000')
+        if color not in colors:
+            colors.append(color)
+        segments, points_in, points_out = simplify_route(zoom_level, get_segment_arrays_from_gpx(file_path))
+        total_points_in += points_in
+        total_points_out += points_out
+        tracks.append([colors.index(color)] + [encode_segment(latitudes, longitudes) for latitudes, longitudes in segments])
+    print_simplification(total_points_in, total_points_out)
+    track_data = json.dumps({'colors': colors, 'tracks': tracks}, separators=(',', ':'))
+    script = f'''
+    var gpxTracks = {track_data};
+    var shownLayers = [];
+
+    function decodeSegment(deltas) {{
+        var lat = 0, lon = 0, coords = [];
+        for (var i = 0; i < deltas.length; i += 2) {{
+            lat += deltas[i];
+            lon += deltas[i + 1];
+            coords.push([lat / {COORDINATE_SCALE}, lon / {COORDINATE_SCALE}]);
+        }}
+        return coords;
+    }}
+
+    function showTracks(count) {{
+        while (shownLayers.length > count) {{
+            shownLayers.pop().forEach(function (layer) {{ layer.remove(); }});
+        }}
+        while (shownLayers.length < count) {{
+            var track = gpxTracks.tracks[shownLayers.length];
+            var layers = [];
+            for (var i = 1; i < track.length; i++) {{
+                layers.push(L.polyline(decodeSegment(track[i]), {{color: gpxTracks.colors[track[0]], weight: 3.5, opacity: 1}}).addTo({folium_map.get_name()}));
+            }}
+            shownLayers.push(layers);
+        }}
+    }}
+    '''
+    folium_map.get_root().script.add_child(folium.Element(script))
@@ -0,0 +1,105 @@
+# Functions related to caching parsed gpx files
+
+import collections
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from configuration import *
+from gpx_reader import read_gpx_points
+from instrumentation import add_bytes, instrumented
+from util import current_directory, write_file_atomic
+
+CACHE_VERSION = 2
+
+# latitudes, longitudes and times (unix seconds, NaN if missing) are float64 arrays of all points in the file.
+# Segment i is points[offsets[i]:offsets[i + 1]].
+# start_time is the text of the first <time> tag in the file, or None.
+GpxPoints = collections.namedtuple('GpxPoints', ['latitudes', 'longitudes', 'times', 'offsets', 'start_time'])
+
+
+def get_cache_folder():
+    # Bumping CACHE_VERSION moves the cache to a new folder, which invalidates everything cached before
+    return os.path.join(current_directory, GPX_CACHE_FOLDER, f'v{CACHE_VERSION}')
+
+def load_cached_points(digest):
+    folder = get_cache_folder()
+    with open(os.path.join(folder, f'{digest}.json'), 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+    # Empty files can't be memory-mapped
+    points = np.load(os.path.join(folder, f'{digest}.npy'), mmap_mode='r' if meta['point_count'] else None)
+    offsets = np.array(meta['offsets'], dtype=np.int64)
+    return GpxPoints(points[0], points[1], points[2], offsets, meta['start_time'])
+
+def is_cached(digest):
+    folder = get_cache_folder()
+    return (os.path.exists(os.path.join(folder, f'{digest}.json'))
+            and os.path.exists(os.path.join(folder, f'{digest}.npy')))
+
+def save_cached_points(digest, points, offsets, start_time):
+    folder = get_cache_folder()
+    os.makedirs(folder, exist_ok=True)
+    meta = {'point_count': points.shape[1], 'offsets': offsets, 'start_time': start_time}
+    # The .npy is written first, so an existing .json always means the arrays are complete
+    write_file_atomic(os.path.join(folder, f'{digest}.npy'), lambda file: np.save(file, points))
+    write_file_atomic(os.path.join(folder, f'{digest}.json'), lambda file: file.write(json.dumps(meta).encode('utf-8')))
+
+def get_index_path(file_path):
+    return os.path.join(get_cache_folder(), 'index', hashlib.sha1(file_path.encode('utf-8')).hexdigest() + '.json')
+
+def get_indexed_digest(file_path, stat):
+    """Get the content hash recorded for an absolute file path in the cache index, or None if the file has changed since"""
+    try:
+        with open(get_index_path(file_path), 'r', encoding='utf-8') as file:
+            entry = json.load(file)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha1']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def get_file_digest(file_path):
+    """Get the sha1 of a file's content, from the cache index if the file hasn't changed since it was cached"""
+    file_path = os.path.abspath(file_path)
+    if GPX_CACHE:
+        digest = get_indexed_digest(file_path, os.stat(file_path))
+        if digest is not None:
+            return digest
+    with open(file_path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+@instrumented('parse')
+def load_gpx_points(file_path):
+    """Get the points of a gpx file, parsing it only if it has not been cached before.
+
+    Cached files are looked up by path, size and modification time first. If any of those changed,
+    the file is hashed and parsed again only if its content actually changed."""
+    if not GPX_CACHE:
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        add_bytes(read=len(data))
+        points, offsets, start_time = read_gpx_points(data)
+        return GpxPoints(points[0], points[1], points[2], np.array(offsets, dtype=np.int64), start_time)
+
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    digest = get_indexed_digest(file_path, stat)
+    if digest is not None and is_cached(digest):
+        return load_cached_points(digest)
+
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    add_bytes(read=len(data))
+    digest = hashlib.sha1(data).hexdigest()
+    if not is_cached(digest):
+        points, offsets, start_time = read_gpx_points(data)
+        save_cached_points(digest, points, offsets, start_time)
+        add_bytes(written=points.nbytes)
+
+    index_path = get_index_path(file_path)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    entry = {'path': file_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': digest}
+    write_file_atomic(index_path, lambda file: file.write(json.dumps(entry).encode('utf-8')))
+    return load_cached_points(digest)
@@ -1,103 +1,118 @@
-# Functions related to .gpx files
-
-import concurrent.futures
-import gpxpy
-import os
-import re
-import sys
-
-from datetime import datetime
-
-from configuration import *
-from util import current_directory
-
-
-
-def get_datetime_from_gpx(file_path):
-    """Search for the first <time> tag in the gpx file and extract it as datetime"""
-    time_pattern = re.compile(r'<time>(.*?)</time>')
-    
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            match = time_pattern.search(line)
-            if match:
-                time_str = match.group(1)
-                try:
-                    time_dt = datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%SZ')
-                    return time_dt
-                except ValueError as e:
-                    print(f"Error parsing date: {e}")
-                    sys.exit(1)
-    print(f"Error getting date from {file_path}")
-    sys.exit(1)
-    
-
-def get_all_coordinates_from_gpx(file_path):
-    """ Get all coordinates from a gpx file"""
-    latitudes = []
-    longitudes = []
-    
-    print(f'\r{file_path}    ', end='', flush=True)
-    with open(file_path, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-        
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    latitudes.append(point.latitude)
-                    longitudes.append(point.longitude)
-                    
-    return latitudes, longitudes
-
-def get_center_and_bounds(gpx_files, number_of_workers):
-    latitudes = []
-    longitudes = [] 
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=number_of_workers) as executor:
-        results = list(executor.map(get_all_coordinates_from_gpx, gpx_files))
-        
-    for lat_list, lon_list in results:
-        latitudes.extend(lat_list)
-        longitudes.extend(lon_list)
-    
-    if latitudes and longitudes:
-        center_lat = sum(latitudes) / len(latitudes)
-        center_lon = sum(longitudes) / len(longitudes)
-        
-        min_lat = min(latitudes)
-        max_lat = max(latitudes)
-        min_lon = min(longitudes)
-        max_lon = max(longitudes)
-        
-        # Manual adjustment of map boundaries if defined in configuration
-        if ADJUST_BOUNDARIES:
-            min_lat += MIN_LAT_ADJUSTMENT
-            max_lat += MAX_LAT_ADJUSTMENT
-            min_lon += MIN_LON_ADJUSTMENT
-            max_lon += MAX_LON_ADJUSTMENT
-        
-        print('\r                                                              \r', end ='')
-        return center_lat, center_lon, min_lat, max_lat, min_lon, max_lon
-    else:
-        print('Unable to find map boundaries - no gpx files?')
-        sys.exit(1)
-        
-
-def get_gpx_filenames_and_dates():
-    """Create a sorted list of tuples with the gpx filename and the date in it."""
-    files_with_dates = []
-    for filename in os.listdir(INPUT_FOLDER):
-        if filename.endswith('.gpx'):
-            file_path = os.path.join(current_directory, INPUT_FOLDER, filename)
-            file_date = get_datetime_from_gpx(file_path)
-            if file_date == None:
-                file_date = datetime.now()
-            files_with_dates.append((file_path, file_date))
-            print(f'\r{filename}: {file_date}                   ', end='', flush=True)
-            
-    if SORT_BY_NAME:
-        files_with_dates.sort(key=lambda x: os.path.basename(x[0]).lower())
-    else:  # Default sorting by date
-        files_with_dates.sort(key=lambda x: x[1])
-    print(f'\r                                                  ')
-    return files_with_dates
+# Functions related to .gpx files
+
+import concurrent.futures
+import os
+import sys
+
+from datetime import datetime
+
+from configuration import *
+from gpx_cache import load_gpx_points
+from gpx_reader import TIME_PATTERN
+from route_bounds import CoordinateSummary
+from util import current_directory
+
+# Number of gpx files each worker summarizes at a time when finding the map bounds
+BOUNDS_BATCH_SIZE = 16
+
+
+def get_start_time_text(file_path):
+    """Get the text of the first <time> tag in the gpx file, or None if there is none.
+    It's in the cache along with the points, otherwise the file is only read up to the tag."""
+    if GPX_CACHE:
+        return load_gpx_points(file_path).start_time
+    with open(file_path, 'rb') as file:
+        for line in file:
+            match = TIME_PATTERN.search(line)
+            if match:
+                return match.group(1).decode('utf-8')
+    return None
+
+def get_datetime_from_gpx(file_path):
+    """Get the first <time> tag in the gpx file as datetime"""
+    time_str = get_start_time_text(file_path)
+    if time_str is None:
+        print(f"Error getting date from {file_path}")
+        sys.exit(1)
+    try:
+        time_dt = datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%SZ')
+        return time_dt
+    except ValueError as e:
+        print(f"Error parsing date: {e}")
+        sys.exit(1)
+    
+
+def get_coordinate_summary(file_path, sketch):
+    """Summarize the coordinates in a gpx file, see CoordinateSummary"""
+    print(f'\r{file_path}    ', end='', flush=True)
+    points = load_gpx_points(file_path)
+    summary = CoordinateSummary(sketch)
+    summary.add(points.latitudes, points.longitudes)
+    return summary
+
+def summarize_gpx_files(file_paths, sketch):
+    """Summarize the coordinates in the gpx files into one CoordinateSummary, so a worker sends back just one small summary"""
+    summary = CoordinateSummary(sketch)
+    for file_path in file_paths:
+        summary.merge(get_coordinate_summary(file_path, sketch))
+    return summary
+
+def get_segment_arrays_from_gpx(file_path):
+    """Get the (latitudes, longitudes) arrays of each track segment in a gpx file"""
+    points = load_gpx_points(file_path)
+    return [(points.latitudes[start:end], points.longitudes[start:end])
+            for start, end in zip(points.offsets[:-1], points.offsets[1:])]
+
+def get_center_and_bounds(gpx_files, number_of_workers, summary=None):
+    """Find the mean point and the bounds of the routes. The workers summarize batches of files, which are merged here as they finish.
+
+    A summary of the files that's already known, e.g. from the activity catalog, is used instead of reading the files,
+    unless BOUNDS_OUTLIER_PERCENT needs the points."""
+    sketch = BOUNDS_OUTLIER_PERCENT > 0
+    if summary is None or sketch:
+        batches = [gpx_files[i:i + BOUNDS_BATCH_SIZE] for i in range(0, len(gpx_files), BOUNDS_BATCH_SIZE)]
+        summary = CoordinateSummary(sketch)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+            for batch_summary in executor.map(summarize_gpx_files, batches, [sketch] * len(batches)):
+                summary.merge(batch_summary)
+
+    if summary.count:
+        center_lat, center_lon, min_lat, max_lat, min_lon, max_lon = summary.get_center_and_bounds(BOUNDS_OUTLIER_PERCENT)
+        if VERBOSE_OUTPUT and sketch:
+            print(f'\rAll points: latitude {summary.min_lat} to {summary.max_lat}, longitude {summary.min_lon} to {summary.max_lon}')
+        
+        # Manual adjustment of map boundaries if defined in configuration
+        if ADJUST_BOUNDARIES:
+            min_lat += MIN_LAT_ADJUSTMENT
+            max_lat += MAX_LAT_ADJUSTMENT
+            min_lon += MIN_LON_ADJUSTMENT
+            max_lon += MAX_LON_ADJUSTMENT
+        
+        print('\r                                                              \r', end ='')
+        return center_lat, center_lon, min_lat, max_lat, min_lon, max_lon
+    else:
+        print('Unable to find map boundaries - no gpx files?')
+        sys.exit(1)
+        
+
+def get_gpx_filenames_and_dates():
+    """Create a sorted list of tuples with the gpx filename and the date in it."""
+    files_with_dates = []
+    for filename in os.listdir(INPUT_FOLDER):
+        if filename.endswith('.gpx'):
+            file_path = os.path.join(current_directory, INPUT_FOLDER, filename)
+            file_date = get_datetime_from_gpx(file_path)
+            if file_date == None:
+                file_date = datetime.now()
+            files_with_dates.append((file_path, file_date))
+            print(f'\r{filename}: {file_date}                   ', end='', flush=True)
+            
+    sort_gpx_filenames_and_dates(files_with_dates)
+    print(f'\r                                                  ')
+    return files_with_dates
+
+def sort_gpx_filenames_and_dates(files_with_dates):
+    if SORT_BY_NAME:
+        files_with_dates.sort(key=lambda x: os.path.basename(x[0]).lower())
+    else:  # Default sorting by date
+        files_with_dates.sort(key=lambda x: x[1])
@@ -0,0 +1,105 @@
+# Streaming gpx reader that collects track points straight into arrays, without building a gpxpy object for every point
+
+import math
+import re
+import xml.etree.ElementTree as ET
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+TIME_PATTERN = re.compile(rb'<time>(.*?)</time>')
+FRACTION_PATTERN = re.compile(r'\.(\d+)')
+CHUNK_SIZE = 1 << 16
+
+
+def parse_time(time_str):
+    """Parse a gpx timestamp into unix seconds the same way gpxpy's datetime.timestamp() does. Raises ValueError if it can't be parsed."""
+    time_str = time_str.strip()
+    # datetime.fromisoformat takes a Z, or fractions of seconds with other than 3 or 6 digits, only from Python 3.11 on
+    if time_str[-1:] in ('Z', 'z'):
+        time_str = time_str[:-1] + '+00:00'
+    time_str = FRACTION_PATTERN.sub(lambda match: '.' + match.group(1)[:6].ljust(6, '0'), time_str, count=1)
+    return datetime.fromisoformat(time_str).timestamp()
+
+class TrackPointTarget:
+    """XMLParser target that appends track points to arrays as the parser streams through the file.
+
+    No element tree is built at all, so memory use only depends on the number of points."""
+    def __init__(self):
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.times = array('d')
+        self.offsets = [0]
+        self.local_names = {}
+        self.depth = 0
+        self.point_depth = None
+        self.time_text = None
+        self.point_time = math.nan
+        self.bad_time_count = 0
+        self.bad_time = None
+
+    def local_name(self, tag):
+        """Strip the namespace from a tag, remembering the result because the same few tags repeat for every point"""
+        name = self.local_names.get(tag)
+        if name is None:
+            name = self.local_names[tag] = tag.rpartition('}')[2]
+        return name
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        name = self.local_name(tag)
+        if name == 'trkpt':
+            self.latitudes.append(float(attrib['lat']))
+            self.longitudes.append(float(attrib['lon']))
+            self.point_depth = self.depth
+            self.point_time = math.nan
+        elif name == 'time' and self.point_depth == self.depth - 1:
+            # Only the point's own <time>, not any timestamps in its extensions
+            self.time_text = []
+
+    def data(self, text):
+        if self.time_text is not None:
+            self.time_text.append(text)
+
+    def end(self, tag):
+        self.depth -= 1
+        name = self.local_name(tag)
+        if name == 'time' and self.time_text is not None:
+            time_str = ''.join(self.time_text)
+            self.time_text = None
+            try:
+                self.point_time = parse_time(time_str)
+            except ValueError:
+                # The point is kept without a time
+                self.bad_time_count += 1
+                self.bad_time = self.bad_time or time_str
+        elif name == 'trkpt':
+            self.times.append(self.point_time)
+            self.point_depth = None
+        elif name == 'trkseg':
+            self.offsets.append(len(self.latitudes))
+
+    def close(self):
+        return self
+
+def read_gpx_points(data):
+    """Read gpx file contents (bytes) into a (3, n) float64 array of lat/lon/time, segment offsets and the first <time> text.
+
+    Gives the same points and segments as going through gpx.tracks / track.segments / segment.points with gpxpy.
+    Segment i is points[:, offsets[i]:offsets[i + 1]]."""
+    parser = ET.XMLParser(target=TrackPointTarget())
+    for position in range(0, len(data), CHUNK_SIZE):
+        parser.feed(data[position:position + CHUNK_SIZE])
+    target = parser.close()
+    if target.bad_time_count:
+        print(f'\r{target.bad_time_count} point times could not be read, e.g. {target.bad_time.strip()!r}. Those points have no time.')
+
+    points = np.empty((3, len(target.latitudes)), dtype=np.float64)
+    points[0] = np.frombuffer(target.latitudes, dtype=np.float64)
+    points[1] = np.frombuffer(target.longitudes, dtype=np.float64)
+    points[2] = np.frombuffer(target.times, dtype=np.float64)
+
+    match = TIME_PATTERN.search(data)
+    start_time = match.group(1).decode('utf-8') if match else None
+    return points, target.offsets, start_time
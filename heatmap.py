@@ -0,0 +1,176 @@
+# Functions related to rendering the routes as a heatmap over the map tiles
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+from configuration import *
+from gpx_files import get_segment_arrays_from_gpx
+from instrumentation import instrumented
+from native_map import create_base_image, get_view_origin
+from projection import project_to_pixels
+from render_shards import get_last_frame, save_keyframe
+from route_animation import get_route_progress, split_route
+from simplify import print_simplification, simplify_route
+
+LINE_WIDTH = 2
+# Opacity of the heat on pixels with one activity, rising to 1 at HEATMAP_SATURATION activities
+MIN_OPACITY = 0.5
+# Counts are kept as 16-bit numbers, which is plenty as colors stop changing at HEATMAP_SATURATION
+MAX_COUNT = np.iinfo(np.uint16).max
+
+
+def get_colormap(colors):
+    """Get a 256 x 3 lookup table that goes evenly through the colors"""
+    stops = np.array([ImageColor.getrgb(color)[:3] for color in colors], dtype=np.float32)
+    positions = np.linspace(0, 255, len(stops))
+    return np.stack([np.interp(np.arange(256), positions, stops[:, channel]) for channel in range(3)], axis=1)
+
+def get_heat(counts):
+    """Get the heat of pixels from their activity counts: 0 at one activity and 1 at HEATMAP_SATURATION activities.
+    The fixed scale keeps the colors of a pixel the same however many activities the other pixels get."""
+    return np.clip(np.log(np.maximum(counts, 1)) / np.log(max(HEATMAP_SATURATION, 2)), 0, 1)
+
+
+class HeatmapCanvas:
+    """Activity counts per pixel and the heatmap image colored from them.
+
+    Adding a route only counts and recolors the pixels in the route's bounding box, so the cost of a frame depends on
+    the size of the new route, not on the routes before it. With HEATMAP_YEAR_COLORS, there's a count channel per year,
+    and pixels get the mix of the YEAR_COLORS of the activities through them."""
+
+    def __init__(self, base_image):
+        self.base = np.asarray(base_image.convert('RGB'), dtype=np.float32)
+        self.image = base_image.convert('RGB')
+        self.height, self.width = self.base.shape[:2]
+        self.counts = np.zeros((self.height, self.width), dtype=np.uint16)
+        self.colormap = get_colormap(HEATMAP_COLORS)
+        self.year_counts = {}
+        # Pixels the current route has already been counted on, so a route that is added in parts or crosses itself counts once
+        self.route_pixels = np.zeros((self.height, self.width), dtype=bool)
+        self.route_regions = []
+        self.route_year = None
+
+    def get_keyframe_state(self):
+        """Get the counts and the image as the state of a keyframe, see render_shards"""
+        years = sorted(self.year_counts)
+        return {'image': np.asarray(self.image), 'counts': self.counts, 'years': np.array(years, dtype=np.int64),
+                'year_counts': np.array([self.year_counts[year] for year in years], dtype=np.uint16).reshape(-1, self.height, self.width)}
+
+    def load_keyframe_state(self, state):
+        self.image = Image.fromarray(state['image'])
+        self.counts = state['counts'].copy()
+        self.year_counts = {int(year): year_counts.copy() for year, year_counts in zip(state['years'], state['year_counts'])}
+
+    def get_lines_mask(self, lines):
+        """Rasterize pixel (x, y) lines into a mask of their bounding box in the view. Returns the mask and its region, or None off the view."""
+        margin = LINE_WIDTH
+        all_x = np.concatenate([pixel_x for pixel_x, _ in lines])
+        all_y = np.concatenate([pixel_y for _, pixel_y in lines])
+        left = max(0, int(np.floor(all_x.min())) - margin)
+        top = max(0, int(np.floor(all_y.min())) - margin)
+        right = min(self.width, int(np.ceil(all_x.max())) + margin + 1)
+        bottom = min(self.height, int(np.ceil(all_y.max())) + margin + 1)
+        if left >= right or top >= bottom:
+            return None
+        mask = Image.new('1', (right - left, bottom - top), 0)
+        draw = ImageDraw.Draw(mask)
+        for pixel_x, pixel_y in lines:
+            draw.line(np.column_stack((pixel_x - left, pixel_y - top)).ravel().tolist(), fill=1, width=LINE_WIDTH, joint='curve')
+        return np.asarray(mask), np.s_[top:bottom, left:right]
+
+    def start_route(self, year):
+        # Clearing just the regions of the previous route keeps this as cheap as that route was
+        for region in self.route_regions:
+            self.route_pixels[region] = False
+        self.route_regions = []
+        self.route_year = year
+
+    @instrumented('draw')
+    def add_lines(self, lines):
+        """Count the current route on the pixels the lines pass through, except those it has already been counted on,
+        and recolor those pixels"""
+        if not lines:
+            return
+        lines_mask = self.get_lines_mask(lines)
+        if lines_mask is None:
+            return
+        mask, region = lines_mask
+        new_pixels = mask & ~self.route_pixels[region]
+        self.route_pixels[region] |= mask
+        self.route_regions.append(region)
+        self.counts[region] = np.minimum(self.counts[region].astype(np.uint32) + new_pixels, MAX_COUNT)
+        if HEATMAP_YEAR_COLORS:
+            if self.route_year not in self.year_counts:
+                self.year_counts[self.route_year] = np.zeros((self.height, self.width), dtype=np.uint16)
+            year_counts = self.year_counts[self.route_year]
+            year_counts[region] = np.minimum(year_counts[region].astype(np.uint32) + new_pixels, MAX_COUNT)
+        self.image.paste(Image.fromarray(self.color_region(region)), (region[1].start, region[0].start))
+
+    def add_route(self, zoom, origin_x, origin_y, segments, year):
+        """Count the (latitudes, longitudes) segments of a route once on every pixel it passes through and recolor those pixels"""
+        self.start_route(year)
+        self.add_lines([project_to_pixels(zoom, latitudes, longitudes, origin_x, origin_y)
+                        for latitudes, longitudes in segments if len(latitudes) > 1])
+
+    def color_region(self, region):
+        counts = self.counts[region]
+        heat = get_heat(counts)
+        if HEATMAP_YEAR_COLORS:
+            # Mix of the year colors, weighted by the activities of each year
+            color = np.zeros(counts.shape + (3,), dtype=np.float32)
+            for year, year_counts in self.year_counts.items():
+                year_color = np.array(ImageColor.getrgb(YEAR_COLORS.get(year, '#000000'))[:3], dtype=np.float32)
+                color += year_counts[region][..., np.newaxis].astype(np.float32) * year_color
+            color /= np.maximum(counts, 1)[..., np.newaxis]
+        else:
+            color = self.colormap[np.round(heat * 255).astype(np.uint8)]
+        opacity = np.where(counts > 0, MIN_OPACITY + (1 - MIN_OPACITY) * heat, 0)[..., np.newaxis]
+        return np.round(self.base[region] * (1 - opacity) + color * opacity).astype(np.uint8)
+
+
+def generate_heatmap_frames(gpx_filenames_with_dates, zoom, center_lat, center_lon, width, height, frame_indices=None, sub_frames=1,
+                            keyframe=None, keyframe_paths=None):
+    """Add the routes one by one to a heatmap over a stitched tile image, yielding (frame index, heatmap image) after each route.
+    The same image is updated and yielded every time, so copy it if it needs to be kept.
+    If frame_indices is given, the routes up to the last of them are still added but only those frames are yielded.
+    With sub_frames, each route is added in that many parts, and keyframes are started from and saved, like in generate_native_frames."""
+    if frame_indices is not None:
+        frame_indices = set(frame_indices)
+    keyframe_paths = keyframe_paths or {}
+    last_frame = get_last_frame(len(gpx_filenames_with_dates), frame_indices, keyframe_paths)
+    origin_x, origin_y = get_view_origin(zoom, center_lat, center_lon, width, height)
+    canvas = HeatmapCanvas(create_base_image(zoom, origin_x, origin_y, width, height))
+    first_frame = 0
+    if keyframe is not None:
+        first_frame, state = keyframe
+        canvas.load_keyframe_state(state)
+
+    total_points_in = 0
+    total_points_out = 0
+    for current_map, (file_path, date) in enumerate(gpx_filenames_with_dates):
+        if current_map < first_frame:
+            continue
+        if current_map in keyframe_paths:
+            save_keyframe(keyframe_paths[current_map], current_map, canvas.get_keyframe_state())
+        if current_map > last_frame:
+            break
+        yield_frame = frame_indices is None or current_map in frame_indices
+        if sub_frames > 1:
+            pixel_segments, progress, points_in, points_out = get_route_progress(zoom, file_path, origin_x, origin_y)
+            total_points_in += points_in
+            total_points_out += points_out
+            canvas.start_route(date.year)
+            for lines in split_route(pixel_segments, progress, sub_frames):
+                canvas.add_lines(lines)
+                if yield_frame:
+                    yield current_map, canvas.image
+            continue
+
+        segments, points_in, points_out = simplify_route(zoom, get_segment_arrays_from_gpx(file_path))
+        total_points_in += points_in
+        total_points_out += points_out
+        canvas.add_route(zoom, origin_x, origin_y, segments, date.year)
+        if yield_frame:
+            yield current_map, canvas.image
+    print('\r                                                                                                 \r', end='')
+    print_simplification(total_points_in, total_points_out)
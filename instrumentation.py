@@ -0,0 +1,326 @@
+# Functions related to timing the stages of a run and writing the run report
+#
+# Stages of main() are timed with 'with stage(name):'. Work items, also those done in worker processes and threads,
+# are timed with the @instrumented(name) decorator. Every process appends its records to a file of its own in the
+# records folder, and the report is put together from those files at the end of the run.
+# Nothing is recorded unless a report has been started, so the decorated functions cost next to nothing otherwise.
+
+import contextlib
+import cProfile
+import csv
+import functools
+import json
+import multiprocessing.util
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then left out of the report
+    resource = None
+
+from configuration import *
+from util import current_directory
+
+# Worker processes find the records folder and the profiled stages in these environment variables
+RECORDS_FOLDER_VARIABLE = 'GPX_TIMELAPSE_RECORDS'
+PROFILE_STAGES_VARIABLE = 'GPX_TIMELAPSE_PROFILE'
+REPORT_NAME = 'run_report'
+# Upper limits of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+record_lock = threading.Lock()
+record_file = None
+record_process = None
+current_items = threading.local()
+current_stages = []
+profilers = {}
+# Only one profiler can be enabled at a time, so items aren't profiled inside a profiled stage
+stage_profilers = []
+
+
+def get_records_folder():
+    return os.environ.get(RECORDS_FOLDER_VARIABLE)
+
+def get_profile_stages():
+    return [name for name in os.environ.get(PROFILE_STAGES_VARIABLE, '').split(',') if name]
+
+def get_peak_rss():
+    """Peak resident memory in bytes of this process, or None if it can't be measured"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes, except on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def get_children_peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def check_process():
+    """Forked worker processes start with the records file and the profilers of the main process, which they must not use.
+    A worker forked inside a profiled stage also starts with the stage's profiler enabled, which would keep its items from being profiled."""
+    global record_file, record_process
+    if record_process != os.getpid():
+        record_file = None
+        profilers.clear()
+        for profiler in stage_profilers:
+            profiler.disable()
+        stage_profilers.clear()
+        record_process = os.getpid()
+
+def dump_profiles():
+    """Write the item profiles of this process into the records folder"""
+    with record_lock:
+        if record_process != os.getpid() or not get_records_folder():
+            # Profilers inherited from the main process, which are its to write
+            return
+        for name, profiler in profilers.items():
+            profiler.dump_stats(os.path.join(get_records_folder(), f'{name}.{os.getpid()}.prof'))
+
+def write_record(record):
+    global record_file
+    with record_lock:
+        check_process()
+        if record_file is None:
+            # Line buffered, so the records are on disk even if the worker process is killed
+            record_file = open(os.path.join(get_records_folder(), f'{os.getpid()}.jsonl'), 'a', encoding='utf-8', buffering=1)
+        record_file.write(json.dumps(record) + '\n')
+
+def add_bytes(read=0, written=0):
+    """Count bytes read or written for the item being timed in this thread, or else for the current stage"""
+    if not get_records_folder():
+        return
+    counters = getattr(current_items, 'counters', None)
+    if counters is None and current_stages:
+        counters = current_stages[-1]
+    if counters is not None:
+        counters['bytes_read'] += read
+        counters['bytes_written'] += written
+
+def add_queue_wait(seconds):
+    """Count time the item being timed in this thread spent waiting for its turn"""
+    counters = getattr(current_items, 'counters', None)
+    if counters is not None:
+        counters['queue_wait'] += seconds
+
+def get_profiler(name):
+    """Get the profiler of the items of a stage in this process. The profiles are written only once, when the process exits,
+    or in write_run_report for the main process."""
+    if name not in get_profile_stages() or stage_profilers or threading.current_thread() is not threading.main_thread():
+        return None
+    if name not in profilers:
+        if not profilers:
+            # Also run when worker processes of multiprocessing exit, unlike atexit
+            multiprocessing.util.Finalize(None, dump_profiles, exitpriority=0)
+        profilers[name] = cProfile.Profile()
+    return profilers[name]
+
+def instrumented(name):
+    """Decorator that times each call of the function as an item of the named stage while a report is being made"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not get_records_folder() or getattr(current_items, 'counters', None) is not None:
+                # Not reporting, or called from inside another timed item
+                return function(*args, **kwargs)
+
+            with record_lock:
+                check_process()
+            current_items.counters = {'bytes_read': 0, 'bytes_written': 0, 'queue_wait': 0.0}
+            profiler = get_profiler(name)
+            start_time = time.time()
+            start_counter = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latency = time.perf_counter() - start_counter
+                if profiler:
+                    profiler.disable()
+                counters = current_items.counters
+                current_items.counters = None
+                write_record({'type': 'item', 'name': name, 'worker': f'{os.getpid()}-{threading.current_thread().name}',
+                              'start': start_time, 'latency': latency, 'peak_rss': get_peak_rss(), **counters})
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of the run in the main process"""
+    if not get_records_folder():
+        yield
+        return
+
+    counters = {'bytes_read': 0, 'bytes_written': 0}
+    current_stages.append(counters)
+    profiler = cProfile.Profile() if name in get_profile_stages() and not stage_profilers else None
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    if profiler:
+        stage_profilers.append(profiler)
+        profiler.enable()
+    try:
+        yield
+    finally:
+        wall_time = time.perf_counter() - start_counter
+        if profiler:
+            profiler.disable()
+            stage_profilers.pop()
+            profiler.dump_stats(os.path.join(get_records_folder(), f'{name}.stage.prof'))
+        current_stages.pop()
+        write_record({'type': 'stage', 'name': name, 'start': start_time, 'wall_time': wall_time,
+                      'peak_rss': get_peak_rss(), 'children_peak_rss': get_children_peak_rss(), **counters})
+
+def get_report_folder():
+    return os.path.join(current_directory, OUTPUT_FOLDER)
+
+def start_run_report(profile_stages=()):
+    """Start recording. Must be called before any worker processes are started, so that they inherit the settings."""
+    records_folder = os.path.join(get_report_folder(), REPORT_NAME + '_records')
+    shutil.rmtree(records_folder, ignore_errors=True)
+    os.makedirs(records_folder)
+    os.environ[RECORDS_FOLDER_VARIABLE] = records_folder
+    os.environ[PROFILE_STAGES_VARIABLE] = ','.join(profile_stages)
+
+def read_records(records_folder):
+    records = []
+    for filename in sorted(os.listdir(records_folder)):
+        if filename.endswith('.jsonl'):
+            with open(os.path.join(records_folder, filename), 'r', encoding='utf-8') as file:
+                # A worker that was killed can leave half a line at the end
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+    return records
+
+def get_percentile(sorted_values, percentile):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+def get_histogram_label(limit):
+    return f'<{limit}ms' if limit is not None else f'>={HISTOGRAM_BUCKETS_MS[-1]}ms'
+
+def summarize_items(name, items):
+    """Latency percentiles and histogram, throughput, bytes and per-worker utilization of the items of a stage"""
+    latencies = sorted(item['latency'] for item in items)
+    first_start = min(item['start'] for item in items)
+    span = max(item['start'] + item['latency'] for item in items) - first_start
+
+    histogram = {get_histogram_label(limit): 0 for limit in HISTOGRAM_BUCKETS_MS + [None]}
+    for latency in latencies:
+        histogram[get_histogram_label(next((limit for limit in HISTOGRAM_BUCKETS_MS if latency * 1000 < limit), None))] += 1
+
+    workers = {}
+    for item in items:
+        worker = workers.setdefault(item['worker'], {'items': 0, 'busy_time': 0.0, 'queue_wait': 0.0, 'first_start': item['start'], 'peak_rss': None})
+        worker['items'] += 1
+        worker['busy_time'] += item['latency']
+        worker['queue_wait'] += item['queue_wait']
+        worker['first_start'] = min(worker['first_start'], item['start'])
+        if item['peak_rss'] is not None:
+            worker['peak_rss'] = max(worker['peak_rss'] or 0, item['peak_rss'])
+    for worker in workers.values():
+        worker['utilization'] = worker['busy_time'] / span if span > 0 else None
+        # Time from the first item of the stage until the worker got its first item
+        worker['start_delay'] = worker.pop('first_start') - first_start
+
+    return {
+        'name': name,
+        'items': len(items),
+        'span': span,
+        'items_per_second': len(items) / span if span > 0 else None,
+        'latency_mean': sum(latencies) / len(latencies),
+        'latency_p50': get_percentile(latencies, 50),
+        'latency_p90': get_percentile(latencies, 90),
+        'latency_p99': get_percentile(latencies, 99),
+        'latency_max': latencies[-1],
+        'latency_histogram': histogram,
+        'queue_wait': sum(item['queue_wait'] for item in items),
+        'bytes_read': sum(item['bytes_read'] for item in items),
+        'bytes_written': sum(item['bytes_written'] for item in items),
+        'peak_rss': max((worker['peak_rss'] for worker in workers.values() if worker['peak_rss'] is not None), default=None),
+        'workers': workers,
+    }
+
+def merge_profiles(records_folder, report_folder):
+    """Merge the profiles of each stage from all processes into one file per stage. Returns the paths of the files."""
+    profiles = {}
+    for filename in sorted(os.listdir(records_folder)):
+        if filename.endswith('.prof'):
+            profiles.setdefault(filename.split('.')[0], []).append(os.path.join(records_folder, filename))
+    profile_paths = []
+    for name, paths in profiles.items():
+        profile_path = os.path.join(report_folder, f'{REPORT_NAME}_{name}.prof')
+        pstats.Stats(*paths).dump_stats(profile_path)
+        profile_paths.append(profile_path)
+    return profile_paths
+
+def write_run_report():
+    """Put the records together into a JSON report and a CSV summary in the output folder, and stop recording.
+    Returns the path of the JSON report, or None if no report was started."""
+    global record_file
+    records_folder = get_records_folder()
+    if not records_folder:
+        return None
+    dump_profiles()
+    with record_lock:
+        if record_file is not None:
+            record_file.close()
+            record_file = None
+
+    records = read_records(records_folder)
+    stages = [record for record in records if record['type'] == 'stage']
+    items = {}
+    for record in records:
+        if record['type'] == 'item':
+            items.setdefault(record['name'], []).append(record)
+    report_folder = get_report_folder()
+    report = {
+        'stages': sorted(stages, key=lambda record: record['start']),
+        'items': [summarize_items(name, name_items) for name, name_items in items.items()],
+        'profiles': merge_profiles(records_folder, report_folder),
+    }
+    for record in report['stages']:
+        del record['type']
+
+    report_path = os.path.join(report_folder, REPORT_NAME + '.json')
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=1)
+
+    # One row for each stage and each kind of item
+    columns = ['kind', 'name', 'wall_time', 'items', 'items_per_second', 'latency_mean', 'latency_p50', 'latency_p90', 'latency_p99',
+               'latency_max', 'queue_wait', 'bytes_read', 'bytes_written', 'peak_rss', 'workers', 'mean_utilization']
+    with open(os.path.join(report_folder, REPORT_NAME + '.csv'), 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, columns, extrasaction='ignore')
+        writer.writeheader()
+        for record in report['stages']:
+            writer.writerow({'kind': 'stage', **record})
+        for summary in report['items']:
+            utilizations = [worker['utilization'] for worker in summary['workers'].values() if worker['utilization'] is not None]
+            writer.writerow({'kind': 'items', **summary, 'wall_time': summary['span'], 'workers': len(summary['workers']),
+                             'mean_utilization': sum(utilizations) / len(utilizations) if utilizations else None})
+
+    shutil.rmtree(records_folder, ignore_errors=True)
+    del os.environ[RECORDS_FOLDER_VARIABLE]
+    return report_path
+
+def print_run_report(report_path):
+    with open(report_path, 'r', encoding='utf-8') as file:
+        report = json.load(file)
+    for record in report['stages']:
+        print(f'{record["name"]:<14} {record["wall_time"]:9.2f} s')
+    for summary in report['items']:
+        utilizations = [worker['utilization'] for worker in summary['workers'].values() if worker['utilization'] is not None]
+        utilization = f', {100 * sum(utilizations) / len(utilizations):.0f}% busy' if utilizations else ''
+        queue_wait = f', {summary["queue_wait"]:.2f} s waited' if summary['queue_wait'] else ''
+        print(f'{summary["name"]:<14} {summary["items"]:6} items, p50 {summary["latency_p50"] * 1000:.1f} ms, '
+              f'p99 {summary["latency_p99"] * 1000:.1f} ms on {len(summary["workers"])} workers{utilization}{queue_wait}')
+    print(f'Run report written to {report_path}\n')
@@ -1,82 +1,234 @@
-# Functions related to map tiles
-
-import math
-import os
-import requests
-
-from configuration import *
-
-def deg_to_rad(deg):
-    return deg * (math.pi / 180)
-
-def lat_to_tile(zoom, lat):
-    lat_rad = deg_to_rad(lat)
-    return (1 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2 * (2 ** zoom)
-
-def lon_to_tile(zoom, lon):
-    return (lon + 180) / 360 * (2 ** zoom)
-
-def get_zoom_level(min_lat, max_lat, min_lon, max_lon, map_width, map_height):
-    for zoom in range(20, -1, -1):
-        lat_tile_diff = abs(lat_to_tile(zoom, min_lat) - lat_to_tile(zoom, max_lat))
-        lon_tile_diff = abs(lon_to_tile(zoom, min_lon) - lon_to_tile(zoom, max_lon))
-        
-        lat_pixel_diff = lat_tile_diff * 256
-        lon_pixel_diff = lon_tile_diff * 256
-        
-        if lat_pixel_diff <= map_height and lon_pixel_diff <= map_width:
-            return zoom + ADDITIONAL_ZOOM_LEVELS
-    return 0
-
-def coordinates_to_tile(zoom, lat, lon):
-    """Convert latitude and longitude to map tile coordinates"""
-    lat_rad = math.radians(lat)
-    n = 2.0 ** zoom
-    xtile = int((lon + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
-
-def get_tile_bounds(zoom, min_lat, max_lat, min_lon, max_lon):
-    min_x, min_y = coordinates_to_tile(zoom, max_lat, min_lon)
-    max_x, max_y = coordinates_to_tile(zoom, min_lat, max_lon)
-    return min_x, max_x, min_y, max_y
-
-def download_tile(zoom, x, y, STADIA_API_KEY):
-    tile_folder = os.path.join('html_maps/map_tiles', str(zoom), str(x))
-    tile_path = os.path.join(tile_folder, f'{y}.png')
-    
-    if os.path.exists(tile_path):
-        return False
-  
-    if ALIDADE_MAP:
-        url = f'https://tiles.stadiamaps.com/tiles/alidade_smooth/{zoom}/{x}/{y}.png?api_key={STADIA_API_KEY}'
-        response = requests.get(url)
-    else:
-        url = f'https://tile.openstreetmap.org/{zoom}/{x}/{y}.png'
-        headers = {'User-Agent': 'Byprodcut gpx timelapse creator (byproduct@iki.fi)'}
-        response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        os.makedirs(tile_folder, exist_ok=True)
-        with open(tile_path, 'wb') as file:
-            file.write(response.content)
-        return True
-    else:
-        print(f'Failed to download tile {zoom}/{x}/{y}. HTTP Status code: {response.status_code}')
-
-def download_tiles(zoom, min_x, max_x, min_y, max_y, STADIA_API_KEY):
-    downloaded_tiles = 0
-    skipped_tiles = 0
-    for x in range(min_x - EXTRA_MAP_TILES, max_x + EXTRA_MAP_TILES + 1):
-        for y in range(min_y - EXTRA_MAP_TILES, max_y + EXTRA_MAP_TILES + 1):
-            downloaded = download_tile(zoom, x, y, STADIA_API_KEY)
-            if downloaded:
-                downloaded_tiles += 1
-            else:
-                skipped_tiles += 1
-            if skipped_tiles:
-                print(f'\r{downloaded_tiles} tiles downloaded, {skipped_tiles} already existed.     ', end='', flush=True)
-            else:
-                print(f'\r{downloaded_tiles} tiles downloaded.                                      ', end='', flush=True)
-    print(' ')
-       
\ No newline at end of file
+# Functions related to map tiles
+
+import concurrent.futures
+import math
+import os
+import random
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from configuration import *
+from instrumentation import add_bytes, add_queue_wait, instrumented
+from projection import fit_zoom_level, lat_to_tile_y, lon_to_tile_x, project_to_tiles
+from tile_store import evict_tiles, export_tiles, get_missing_tiles, get_provider_key, mark_tiles_used, open_tile_store, put_tile
+from util import write_file_atomic
+
+# Loose tile files, which the html maps load their tiles from
+TILE_FOLDER = os.path.join('html_maps', 'map_tiles')
+
+# Tile usage policies: OpenStreetMap allows at most 2 parallel connections and no heavy bulk downloading,
+# Stadia Maps is fine with more on the free tier.
+TILE_PROVIDERS = {
+    'osm': {
+        'url': 'https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+        'headers': {'User-Agent': 'Byprodcut gpx timelapse creator (byproduct@iki.fi)'},
+        'workers': 2,
+        'requests_per_second': 10,
+    },
+    'alidade': {
+        'url': 'https://tiles.stadiamaps.com/tiles/alidade_smooth/{z}/{x}/{y}.png?api_key={api_key}',
+        'headers': {},
+        'workers': 8,
+        'requests_per_second': 20,
+    },
+}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Downloaded tiles are committed into the tile store after this many tiles or seconds, so a stopped download keeps most of them
+TILE_COMMIT_COUNT = 100
+TILE_COMMIT_SECONDS = 5
+
+def deg_to_rad(deg):
+    return deg * (math.pi / 180)
+
+def lat_to_tile(zoom, lat):
+    return float(lat_to_tile_y(zoom, lat))
+
+def lon_to_tile(zoom, lon):
+    return float(lon_to_tile_x(zoom, lon))
+
+def get_zoom_level(min_lat, max_lat, min_lon, max_lon, map_width, map_height, fractional=False):
+    """Get the zoom level at which all routes are visible, adjusted by ADDITIONAL_ZOOM_LEVELS.
+    With fractional=True, the routes fill the map exactly in one direction (before the adjustment)."""
+    zoom = fit_zoom_level(min_lat, max_lat, min_lon, max_lon, map_width, map_height, fractional)
+    if zoom is None:
+        return 0
+    return zoom + ADDITIONAL_ZOOM_LEVELS
+
+def coordinates_to_tile(zoom, lat, lon):
+    """Convert latitude and longitude to map tile coordinates"""
+    xtile, ytile = project_to_tiles(zoom, lat, lon)
+    return (int(xtile), int(ytile))
+
+def get_tile_bounds(zoom, min_lat, max_lat, min_lon, max_lon):
+    min_x, min_y = coordinates_to_tile(zoom, max_lat, min_lon)
+    max_x, max_y = coordinates_to_tile(zoom, min_lat, max_lon)
+    return min_x, max_x, min_y, max_y
+
+class RateLimiter:
+    """Spaces out calls from any number of threads to at most requests_per_second"""
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+thread_local = threading.local()
+
+def get_session(workers):
+    """Get a requests session for the current thread, so connections are kept alive between tiles"""
+    if not hasattr(thread_local, 'session'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        thread_local.session = session
+    return thread_local.session
+
+def get_tile_provider():
+    if ALIDADE_MAP:
+        provider = dict(TILE_PROVIDERS['alidade'])
+    else:
+        provider = dict(TILE_PROVIDERS['osm'])
+    if TILE_SERVER_URL:
+        provider['url'] = TILE_SERVER_URL
+    return provider
+
+def get_retry_delay(response, attempt):
+    """Use the server's Retry-After if given, otherwise back off exponentially.
+    Retry-After is capped at the longest backoff, so a bad header can't stall a download thread for hours."""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), TILE_RETRY_BASE_DELAY * 2 ** TILE_DOWNLOAD_RETRIES)
+    return TILE_RETRY_BASE_DELAY * (2 ** attempt) + random.uniform(0, TILE_RETRY_BASE_DELAY)
+
+@instrumented('tile_download')
+def request_tile(session, url, headers, waited):
+    """Request a tile. The time waited for the rate limit and the retry backoff before the request is counted as queue wait,
+    so the time of the request itself is timed apart from the throttling."""
+    add_queue_wait(waited)
+    return session.get(url, headers=headers, timeout=30)
+
+def fetch_tile(zoom, x, y, STADIA_API_KEY, provider=None, rate_limiter=None):
+    """Download a map tile. Returns its png data, or None if downloading failed."""
+    if provider is None:
+        provider = get_tile_provider()
+    url = provider['url'].format(z=zoom, x=x, y=y, api_key=STADIA_API_KEY)
+    session = get_session(provider['workers'])
+
+    wait_start = time.perf_counter()
+    for attempt in range(TILE_DOWNLOAD_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.wait()
+        response = None
+        try:
+            response = request_tile(session, url, provider['headers'], time.perf_counter() - wait_start)
+            if response.status_code == 200:
+                return response.content
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+        except requests.RequestException as e:
+            if attempt == TILE_DOWNLOAD_RETRIES:
+                print(f'Failed to download tile {zoom}/{x}/{y}: {e}')
+                return None
+        if attempt < TILE_DOWNLOAD_RETRIES:
+            wait_start = time.perf_counter()
+            time.sleep(get_retry_delay(response, attempt))
+
+    print(f'Failed to download tile {zoom}/{x}/{y}. HTTP Status code: {response.status_code}')
+    return None
+
+def download_tile(zoom, x, y, STADIA_API_KEY, provider=None, rate_limiter=None):
+    """Download a map tile into the tile folder unless it exists already.
+    Returns True if downloaded, False if it existed and None if downloading failed."""
+    tile_folder = os.path.join(TILE_FOLDER, str(zoom), str(x))
+    tile_path = os.path.join(tile_folder, f'{y}.png')
+    
+    if os.path.exists(tile_path):
+        return False
+
+    tile_data = fetch_tile(zoom, x, y, STADIA_API_KEY, provider, rate_limiter)
+    if tile_data is None:
+        return None
+    os.makedirs(tile_folder, exist_ok=True)
+    # Written to a temporary file first, so a crash never leaves a truncated tile that looks cached
+    write_file_atomic(tile_path, lambda file: file.write(tile_data))
+    add_bytes(written=len(tile_data))
+    return True
+
+def print_download_status(downloaded_tiles, skipped_tiles, failed_tiles):
+    status = f'{downloaded_tiles} tiles downloaded'
+    if skipped_tiles:
+        status += f', {skipped_tiles} already existed'
+    if failed_tiles:
+        status += f', {failed_tiles} failed'
+    print(f'\r{status}.                    ', end='', flush=True)
+
+def download_tiles(zoom, min_x, max_x, min_y, max_y, STADIA_API_KEY, export_files=True):
+    """Download the tiles of the range and EXTRA_MAP_TILES around it. With TILE_STORE, the tiles are kept in the store,
+    and only missing and expired tiles are downloaded. They're also written into the tile folder for the html maps if export_files is set."""
+    provider = get_tile_provider()
+    rate_limiter = RateLimiter(provider['requests_per_second'])
+    min_x, max_x = min_x - EXTRA_MAP_TILES, max_x + EXTRA_MAP_TILES
+    min_y, max_y = min_y - EXTRA_MAP_TILES, max_y + EXTRA_MAP_TILES
+    tiles = [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+    downloaded_tiles = 0
+    skipped_tiles = 0
+    failed_tiles = 0
+    uncommitted_tiles = 0
+    last_commit = time.monotonic()
+    connection = None
+    if TILE_STORE:
+        connection = open_tile_store()
+        provider_key = get_provider_key(provider)
+        missing_tiles = get_missing_tiles(connection, provider_key, zoom, tiles)
+        skipped_tiles = len(tiles) - len(missing_tiles)
+        tiles = missing_tiles
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=provider['workers']) as executor:
+            if connection is not None:
+                # Tiles are downloaded in the threads and put into the store here, as a connection belongs to one thread
+                futures = {executor.submit(fetch_tile, zoom, x, y, STADIA_API_KEY, provider, rate_limiter): (x, y) for x, y in tiles}
+            else:
+                futures = {executor.submit(download_tile, zoom, x, y, STADIA_API_KEY, provider, rate_limiter): (x, y) for x, y in tiles}
+            for future in concurrent.futures.as_completed(futures):
+                downloaded = future.result()
+                if connection is not None and downloaded is not None:
+                    put_tile(connection, provider_key, zoom, *futures[future], downloaded)
+                    uncommitted_tiles += 1
+                    if uncommitted_tiles >= TILE_COMMIT_COUNT or time.monotonic() - last_commit > TILE_COMMIT_SECONDS:
+                        connection.commit()
+                        uncommitted_tiles = 0
+                        last_commit = time.monotonic()
+                if downloaded is None:
+                    failed_tiles += 1
+                elif downloaded is False:
+                    skipped_tiles += 1
+                else:
+                    downloaded_tiles += 1
+                print_download_status(downloaded_tiles, skipped_tiles, failed_tiles)
+            if not futures:
+                print_download_status(downloaded_tiles, skipped_tiles, failed_tiles)
+        if connection is not None:
+            mark_tiles_used(connection, provider_key, zoom, min_x, max_x, min_y, max_y)
+            evicted_tiles = evict_tiles(connection)
+            connection.commit()
+            if export_files:
+                export_tiles(connection, provider_key, zoom, min_x, max_x, min_y, max_y, TILE_FOLDER)
+            if evicted_tiles and VERBOSE_OUTPUT:
+                print(f'\n{evicted_tiles} least recently used tiles removed from the tile store.', end='')
+    finally:
+        if connection is not None:
+            connection.close()
+    print(' ')
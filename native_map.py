@@ -0,0 +1,182 @@
+# Functions related to rendering map images without a browser
+
+import io
+import math
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from configuration import *
+from gpx_files import get_segment_arrays_from_gpx
+from instrumentation import instrumented
+from map_tiles import TILE_FOLDER, get_tile_provider
+from projection import TILE_SIZE, get_tile_zoom, project_to_pixels
+from render_shards import get_last_frame, save_keyframe
+from route_animation import get_route_progress, split_route
+from simplify import print_simplification, simplify_route
+from tile_store import get_mosaic_path, get_provider_key, get_tile_data, load_mosaic, open_tile_store, save_mosaic
+from timestamps import save_stamped_frame
+from util import create_progress_bar_string
+
+BACKGROUND_COLOR = '#dddddd'  # Same grey Leaflet shows for missing tiles
+LINE_WIDTH = 4  # Closest whole pixel width to the 3.5 weight of the folium polylines
+
+
+def get_view_origin(zoom, center_lat, center_lon, width, height):
+    """Get the global pixel coordinates of the top left corner of a view centered on the given coordinates"""
+    center_x, center_y = project_to_pixels(zoom, center_lat, center_lon)
+    # Leaflet rounds the pixel origin too, so the tiles line up the same way as in the html maps
+    return round(float(center_x) - width / 2), round(float(center_y) - height / 2)
+
+def get_view_tiles(zoom, origin_x, origin_y, width, height):
+    """Get the tile zoom level, the size of its tiles in view pixels and the (x, y) tiles covering the view.
+    Tile x is wrapped around the world, and tiles above and below the world are left out."""
+    tile_zoom = get_tile_zoom(zoom)
+    tile_count = 2 ** tile_zoom
+    tile_size = TILE_SIZE * 2 ** (zoom - tile_zoom)
+    tiles = []
+    for tile_x in range(math.floor(origin_x / tile_size), math.floor((origin_x + width - 1) / tile_size) + 1):
+        for tile_y in range(math.floor(origin_y / tile_size), math.floor((origin_y + height - 1) / tile_size) + 1):
+            if 0 <= tile_y < tile_count:
+                tiles.append((tile_x, tile_y))
+    return tile_zoom, tile_size, tiles
+
+def stitch_tiles(zoom, origin_x, origin_y, width, height, read_tile):
+    """Stitch the tiles covering the view into one image. read_tile(tile_zoom, x, y) opens a tile, or returns None if it's missing.
+    At fractional zoom levels the tiles of the nearest zoom level are scaled, like Leaflet does."""
+    image = Image.new('RGB', (width, height), BACKGROUND_COLOR)
+    tile_zoom, tile_size, tiles = get_view_tiles(zoom, origin_x, origin_y, width, height)
+    missing_tiles = 0
+
+    for tile_x, tile_y in tiles:
+        tile = read_tile(tile_zoom, tile_x % 2 ** tile_zoom, tile_y)
+        if tile is None:
+            missing_tiles += 1
+            continue
+        left = round(tile_x * tile_size - origin_x)
+        top = round(tile_y * tile_size - origin_y)
+        with tile:
+            tile = tile.convert('RGB')
+            if tile_size != TILE_SIZE:
+                tile = tile.resize((round((tile_x + 1) * tile_size - origin_x) - left,
+                                    round((tile_y + 1) * tile_size - origin_y) - top), Image.LANCZOS)
+            image.paste(tile, (left, top))
+
+    if missing_tiles and VERBOSE_OUTPUT:
+        print(f'{missing_tiles} map tiles were not found')
+    return image
+
+def create_base_image(zoom, origin_x, origin_y, width, height, tile_folder=TILE_FOLDER):
+    """Stitch the map tiles covering the view into one image. With TILE_STORE, the tiles come from the store, and the stitched
+    image is cached as a memory-mapped mosaic, so runs with the same view don't decode the tiles again. Otherwise the tiles
+    are read from tile_folder."""
+    if not TILE_STORE:
+        def read_tile(tile_zoom, x, y):
+            tile_path = os.path.join(tile_folder, str(tile_zoom), str(x), f'{y}.png')
+            return Image.open(tile_path) if os.path.exists(tile_path) else None
+        return stitch_tiles(zoom, origin_x, origin_y, width, height, read_tile)
+
+    connection = open_tile_store()
+    try:
+        provider_key = get_provider_key(get_tile_provider())
+        tile_zoom, _, tiles = get_view_tiles(zoom, origin_x, origin_y, width, height)
+        wrapped_xs = [tile_x % 2 ** tile_zoom for tile_x, _ in tiles] or [0]
+        tile_ys = [tile_y for _, tile_y in tiles] or [0]
+        tile_range = (min(wrapped_xs), max(wrapped_xs), min(tile_ys), max(tile_ys))
+        mosaic_path = get_mosaic_path(connection, provider_key, zoom, tile_zoom, tile_range, origin_x, origin_y, width, height)
+        mosaic = load_mosaic(mosaic_path)
+        if mosaic is not None:
+            # A copy to draw on, straight from the raw pixels
+            return Image.fromarray(np.array(mosaic))
+
+        def read_tile(tile_zoom, x, y):
+            tile_data = get_tile_data(connection, provider_key, tile_zoom, x, y)
+            return Image.open(io.BytesIO(tile_data)) if tile_data is not None else None
+        image = stitch_tiles(zoom, origin_x, origin_y, width, height, read_tile)
+        save_mosaic(mosaic_path, image)
+        return image
+    finally:
+        connection.close()
+
+@instrumented('draw')
+def draw_route(draw, zoom, origin_x, origin_y, segments, color):
+    """Draw the (latitudes, longitudes) segments of a route"""
+    for latitudes, longitudes in segments:
+        if len(latitudes) > 1:
+            pixel_x, pixel_y = project_to_pixels(zoom, latitudes, longitudes, origin_x, origin_y)
+            draw.line(np.column_stack((pixel_x, pixel_y)).ravel().tolist(), fill=color, width=LINE_WIDTH, joint='curve')
+
+@instrumented('draw')
+def draw_lines(draw, lines, color):
+    """Draw the pixel (x, y) lines of a part of a route"""
+    for pixel_x, pixel_y in lines:
+        draw.line(np.column_stack((pixel_x, pixel_y)).ravel().tolist(), fill=color, width=LINE_WIDTH, joint='curve')
+
+def generate_native_frames(gpx_filenames_with_dates, zoom, center_lat, center_lon, width, height, frame_indices=None, sub_frames=1,
+                           keyframe=None, keyframe_paths=None):
+    """Draw the routes one by one on a stitched tile image, yielding (frame index, cumulative image) after each route.
+    The same image is drawn on and yielded every time, so copy it if it needs to be kept.
+    If frame_indices is given, the routes up to the last of them are still drawn but only those frames are yielded.
+    With sub_frames, each route is drawn in that many parts and the image is yielded after each part, so every frame index
+    comes sub_frames times, the last time with the whole route. Each part only costs drawing that part.
+    Drawing starts from a (first frame, state) keyframe if given, and the image before each first frame in keyframe_paths
+    is saved as a keyframe, see render_shards."""
+    if frame_indices is not None:
+        frame_indices = set(frame_indices)
+    keyframe_paths = keyframe_paths or {}
+    last_frame = get_last_frame(len(gpx_filenames_with_dates), frame_indices, keyframe_paths)
+    origin_x, origin_y = get_view_origin(zoom, center_lat, center_lon, width, height)
+    first_frame = 0
+    if keyframe is not None:
+        first_frame, state = keyframe
+        canvas = Image.fromarray(state['image'])
+    else:
+        canvas = create_base_image(zoom, origin_x, origin_y, width, height)
+    draw = ImageDraw.Draw(canvas)
+
+    total_points_in = 0
+    total_points_out = 0
+    for current_map, (file_path, date) in enumerate(gpx_filenames_with_dates):
+        if current_map < first_frame:
+            continue
+        if current_map in keyframe_paths:
+            save_keyframe(keyframe_paths[current_map], current_map, {'image': np.asarray(canvas)})
+        if current_map > last_frame:
+            break
+        color = YEAR_COLORS.get(date.year, '#000000')
+        yield_frame = frame_indices is None or current_map in frame_indices
+        if sub_frames > 1:
+            pixel_segments, progress, points_in, points_out = get_route_progress(zoom, file_path, origin_x, origin_y)
+            total_points_in += points_in
+            total_points_out += points_out
+            for lines in split_route(pixel_segments, progress, sub_frames):
+                draw_lines(draw, lines, color)
+                if yield_frame:
+                    yield current_map, canvas
+            continue
+
+        segments, points_in, points_out = simplify_route(zoom, get_segment_arrays_from_gpx(file_path))
+        total_points_in += points_in
+        total_points_out += points_out
+        draw_route(draw, zoom, origin_x, origin_y, segments, color)
+        if yield_frame:
+            yield current_map, canvas
+    print('\r                                                                                                 \r', end='')
+    print_simplification(total_points_in, total_points_out)
+
+def render_native_frames(gpx_filenames_with_dates, zoom, center_lat, center_lon, width, height, output_folder, frame_indices=None,
+                         generate_frames=generate_native_frames, keyframe=None):
+    """Draw the routes one by one on a stitched tile image, saving the cumulative image after each route.
+    generate_frames can be another function like generate_native_frames, e.g. generate_heatmap_frames."""
+    image_paths = []
+    for current_map, canvas in generate_frames(gpx_filenames_with_dates, zoom, center_lat, center_lon, width, height, frame_indices,
+                                               keyframe=keyframe):
+        date = gpx_filenames_with_dates[current_map][1]
+        is_last_frame = current_map == len(gpx_filenames_with_dates) - 1
+        image_paths.extend(save_stamped_frame(canvas, output_folder, current_map, date, is_last_frame))
+
+        progress_bar = create_progress_bar_string(current_map + 1, len(gpx_filenames_with_dates), width=50)
+        print(f'\r{progress_bar} {current_map + 1} / {len(gpx_filenames_with_dates)}       ', end='')
+    print('\r                                                                                                 \r')
+    return image_paths
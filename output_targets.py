@@ -0,0 +1,137 @@
+# Functions related to rendering several outputs of the same routes in one run, e.g. in different sizes and crops
+
+import concurrent.futures
+import contextlib
+import io
+import os
+
+from configuration import *
+from heatmap import generate_heatmap_frames
+from instrumentation import stage
+from map_tiles import get_zoom_level
+from native_map import generate_native_frames, get_view_origin, get_view_tiles, render_native_frames
+from run_manifest import get_frame_path, get_previous_view, get_sub_frames
+from util import create_progress_bar_string, current_directory
+from video_output import write_video
+
+
+def get_output_targets():
+    """Get the outputs of the run from OUTPUT_TARGETS, or the one MAP_WIDTH x MAP_HEIGHT output in the output folder.
+    Each target is a dict with its name, output folder, size, zoom offset and crop."""
+    if not OUTPUT_TARGETS:
+        return [{'name': None, 'output_folder': OUTPUT_FOLDER, 'size': (MAP_WIDTH, MAP_HEIGHT), 'zoom_offset': 0, 'crop': None}]
+    return [{'name': target['name'],
+             'output_folder': os.path.join(OUTPUT_FOLDER, target['name']),
+             'size': tuple(target.get('size', (MAP_WIDTH, MAP_HEIGHT))),
+             'zoom_offset': target.get('zoom_offset', 0),
+             'crop': target.get('crop')}
+            for target in OUTPUT_TARGETS]
+
+def get_target_view(target, center_lat, center_lon, min_lat, max_lat, min_lon, max_lon, resume):
+    """Get the zoom level, center and bounds of a target's map from the center and bounds of all routes.
+    A target with a crop is centered on the crop and zoomed to fit it instead. Returns (zoom level, center lat, center lon, bounds)."""
+    if target['crop'] is not None:
+        min_lat, max_lat, min_lon, max_lon = target['crop']
+        center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    elif resume:
+        center_lat, center_lon, min_lat, max_lat, min_lon, max_lon = get_previous_view(center_lat, center_lon, min_lat, max_lat, min_lon, max_lon,
+                                                                                       target['output_folder'])
+    width, height = target['size']
+    zoom_level = get_zoom_level(min_lat, max_lat, min_lon, max_lon, width, height, fractional=FRACTIONAL_ZOOM) + target['zoom_offset']
+    return zoom_level, center_lat, center_lon, (min_lat, max_lat, min_lon, max_lon)
+
+def get_tile_ranges(targets, views):
+    """Get the tiles the maps of the targets show, merged into one (min_x, max_x, min_y, max_y) range for each tile zoom level.
+    A map can be wider or taller than the routes in it, so the tiles are found from the whole view."""
+    tile_ranges = {}
+    for target, (zoom_level, center_lat, center_lon, _) in zip(targets, views):
+        width, height = target['size']
+        tile_zoom, _, tiles = get_view_tiles(zoom_level, *get_view_origin(zoom_level, center_lat, center_lon, width, height), width, height)
+        if not tiles:
+            continue
+        xs = [tile_x % 2 ** tile_zoom for tile_x, _ in tiles]
+        ys = [tile_y for _, tile_y in tiles]
+        min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
+        if tile_zoom in tile_ranges:
+            old_min_x, old_max_x, old_min_y, old_max_y = tile_ranges[tile_zoom]
+            min_x, max_x, min_y, max_y = min(min_x, old_min_x), max(max_x, old_max_x), min(min_y, old_min_y), max(max_y, old_max_y)
+        tile_ranges[tile_zoom] = (min_x, max_x, min_y, max_y)
+    return tile_ranges
+
+
+def get_frame_generator(renderer):
+    """Get the function that draws the frames of a renderer that doesn't need a browser"""
+    return generate_heatmap_frames if renderer == 'heatmap' else generate_native_frames
+
+def get_image_paths(frame_count, output_folder=OUTPUT_FOLDER):
+    image_paths = [get_frame_path(index, output_folder=output_folder) for index in range(frame_count)]
+    if TIMESTAMPS and frame_count:
+        # Extra copy of the last image, stamped with just the year
+        image_paths.append(get_frame_path(frame_count - 1, '_last', output_folder))
+    return image_paths
+
+def write_image_list(image_paths, output_folder=OUTPUT_FOLDER):
+    """Create images.txt for use with ffmpeg"""
+    if image_paths:
+        textfile_path = os.path.join(current_directory, output_folder, 'images.txt')
+        with open(textfile_path, "w", encoding = 'utf-8') as f:
+            f.write('\n'.join(f"file '{image_path}'" for image_path in image_paths))
+
+def render_target(renderer, target, gpx_filenames_with_dates, view, frame_indices):
+    """Draw the frame indices of a target with the native or heatmap renderer, into a video if OUTPUT_VIDEO is set"""
+    zoom_level, center_lat, center_lon, _ = view
+    width, height = target['size']
+    output_folder = target['output_folder']
+    generate_frames = get_frame_generator(renderer)
+    frame_count = len(gpx_filenames_with_dates)
+
+    if OUTPUT_VIDEO:
+        reused_frames = set(range(frame_count)) - set(frame_indices)
+        frames = []
+        if frame_indices:
+            print('Drawing map images into a video.')
+            frames = generate_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, width, height, frame_indices,
+                                     get_sub_frames(renderer))
+        # Rendering the frames and writing the video run together
+        with stage('video'):
+            image_paths = write_video(frames, gpx_filenames_with_dates, os.path.join(current_directory, output_folder, OUTPUT_VIDEO),
+                                      reused_frames, get_sub_frames(renderer), output_folder)
+    else:
+        if frame_indices:
+            print('Drawing map images.')
+            with stage('native_render'):
+                render_native_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, width, height,
+                                     os.path.join(current_directory, output_folder), frame_indices, generate_frames)
+        image_paths = get_image_paths(frame_count, output_folder)
+    write_image_list(image_paths, output_folder)
+
+def render_target_quietly(renderer, target, gpx_filenames_with_dates, view, frame_indices):
+    """Render a target in a worker process. Progress bars of parallel targets would overwrite each other,
+    so the output is kept and the messages are returned without them."""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        render_target(renderer, target, gpx_filenames_with_dates, view, frame_indices)
+    # Progress bars are printed over with \r, so only the text after the last \r of a line is left on the screen
+    lines = [line.rsplit('\r', 1)[-1].strip() for line in output.getvalue().split('\n')]
+    return [line for line in lines if line]
+
+def render_targets(renderer, targets, gpx_filenames_with_dates, views, target_frame_indices):
+    """Render the targets, each in a process of its own if there are several.
+    Everything the targets share has been done before this: the gpx files are parsed and cached, and the map tiles downloaded."""
+    if len(targets) == 1:
+        render_target(renderer, targets[0], gpx_filenames_with_dates, views[0], target_frame_indices[0])
+        return
+
+    print(f'Drawing {len(targets)} outputs.')
+    targets_done = 0
+    with stage('targets'), concurrent.futures.ProcessPoolExecutor(max_workers=min(len(targets), number_of_workers)) as executor:
+        futures = {executor.submit(render_target_quietly, renderer, target, gpx_filenames_with_dates, view, frame_indices): target
+                   for target, view, frame_indices in zip(targets, views, target_frame_indices)}
+        for future in concurrent.futures.as_completed(futures):
+            targets_done += 1
+            print('\r                                                                                                 \r', end='')
+            for message in future.result():
+                print(f'{futures[future]["name"]}: {message}')
+            progress_bar = create_progress_bar_string(targets_done, len(targets), width=50)
+            print(f'\r{progress_bar} {targets_done} / {len(targets)}       ', end='')
+    print('\r                                                                                                 \r')
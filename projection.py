@@ -0,0 +1,62 @@
+# Vectorized Web Mercator projection of lat/lon arrays to tile and pixel coordinates
+
+import math
+
+import numpy as np
+
+TILE_SIZE = 256
+MAX_ZOOM = 20
+
+
+def lat_to_tile_y(zoom, latitudes):
+    """Convert latitudes (scalar or array) to fractional tile y coordinates. Zoom may be fractional."""
+    lat_rad = np.asarray(latitudes, dtype=np.float64) * (math.pi / 180)
+    return (1 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / math.pi) / 2 * (2 ** zoom)
+
+def lon_to_tile_x(zoom, longitudes):
+    """Convert longitudes (scalar or array) to fractional tile x coordinates. Zoom may be fractional."""
+    return (np.asarray(longitudes, dtype=np.float64) + 180) / 360 * (2 ** zoom)
+
+def project_to_tiles(zoom, latitudes, longitudes):
+    """Convert lat/lon arrays to fractional tile (x, y) arrays"""
+    return lon_to_tile_x(zoom, longitudes), lat_to_tile_y(zoom, latitudes)
+
+def project_to_pixels(zoom, latitudes, longitudes, origin_x=0, origin_y=0):
+    """Convert lat/lon arrays to pixel (x, y) arrays, relative to the given global pixel origin"""
+    tile_x, tile_y = project_to_tiles(zoom, latitudes, longitudes)
+    return tile_x * TILE_SIZE - origin_x, tile_y * TILE_SIZE - origin_y
+
+def get_tile_zoom(zoom):
+    """Get the zoom level of the map tiles to show at a (possibly fractional) zoom, rounding like Leaflet does"""
+    return math.floor(zoom + 0.5)
+
+def fit_zoom_level(min_lat, max_lat, min_lon, max_lon, map_width, map_height, fractional=False):
+    """Get the highest zoom level (up to MAX_ZOOM) at which the bounds fit in map_width x map_height pixels, or None if not even zoom 0 fits.
+
+    The projected size doubles with every zoom level, so the fitting zoom can be solved directly from the size at zoom 0.
+    With fractional=True the bounds fill the map exactly in one direction."""
+    width_0 = abs(float(lon_to_tile_x(0, min_lon) - lon_to_tile_x(0, max_lon))) * TILE_SIZE
+    height_0 = abs(float(lat_to_tile_y(0, min_lat) - lat_to_tile_y(0, max_lat))) * TILE_SIZE
+
+    scale_limits = []
+    if width_0 > 0:
+        scale_limits.append(map_width / width_0)
+    if height_0 > 0:
+        scale_limits.append(map_height / height_0)
+    if not scale_limits:
+        return MAX_ZOOM
+    zoom = math.log2(min(scale_limits))
+
+    if fractional:
+        return None if zoom < 0 else min(zoom, MAX_ZOOM)
+
+    def fits(zoom):
+        return height_0 * (2 ** zoom) <= map_height and width_0 * (2 ** zoom) <= map_width
+
+    # Rounding in log2 can be off by one right at the limit, so check the neighbouring zoom levels
+    zoom = min(math.floor(zoom), MAX_ZOOM)
+    while zoom < MAX_ZOOM and fits(zoom + 1):
+        zoom += 1
+    while zoom >= 0 and not fits(zoom):
+        zoom -= 1
+    return zoom if zoom >= 0 else None
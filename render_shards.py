@@ -0,0 +1,149 @@
+# Functions related to sharded rendering: the frames are split into shards that start from a keyframe of the map,
+# so they can be rendered by separate processes or machines that share the job folder, and merged back in order
+
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+
+from configuration import *
+from gpx_cache import get_file_digest
+from run_manifest import get_frame_path
+from util import current_directory, write_file_atomic
+
+JOB_FILENAME = 'job.json'
+# Bump when the job or keyframe format changes
+JOB_VERSION = 1
+
+
+def get_job_path(job_folder):
+    return os.path.join(current_directory, job_folder, JOB_FILENAME)
+
+def get_shard_folder(job_folder, shard_index):
+    return os.path.join(current_directory, job_folder, f'shard_{shard_index}')
+
+def get_keyframe_path(job_folder, first_frame):
+    return os.path.join(current_directory, job_folder, 'keyframes', str(first_frame).zfill(8) + '.npz')
+
+def get_shards(frame_indices, shard_count):
+    """Split the frame indices to render into at most shard_count shards of consecutive frames.
+    Returns the first frame and the frame indices of each shard."""
+    shards = []
+    if not len(frame_indices):
+        return shards
+    for frame_indices in np.array_split(np.asarray(frame_indices, dtype=np.int64), max(1, min(shard_count, len(frame_indices)))):
+        shards.append({'first_frame': int(frame_indices[0]), 'frame_indices': frame_indices.tolist()})
+    return shards
+
+def get_last_frame(frame_count, frame_indices, keyframe_paths):
+    """Get the last route a renderer has to draw for the frame indices and the keyframes it saves.
+    All routes are drawn if frame_indices is None."""
+    if frame_indices is None:
+        return frame_count - 1
+    return max([*frame_indices, *(first_frame - 1 for first_frame in keyframe_paths)], default=-1)
+
+def get_segments_state(route_segments):
+    """Pack (route index, latitudes, longitudes) segments into the arrays of a keyframe state"""
+    lengths = [len(latitudes) for _, latitudes, _ in route_segments]
+    return {
+        'routes': np.array([route for route, _, _ in route_segments], dtype=np.int64),
+        'offsets': np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))),
+        'latitudes': np.concatenate([latitudes for _, latitudes, _ in route_segments]) if route_segments else np.empty(0),
+        'longitudes': np.concatenate([longitudes for _, _, longitudes in route_segments]) if route_segments else np.empty(0),
+    }
+
+def get_state_segments(state):
+    """Unpack the (route index, latitudes, longitudes) segments of a keyframe state, see get_segments_state"""
+    offsets = state['offsets']
+    return [(int(route), state['latitudes'][start:end], state['longitudes'][start:end])
+            for route, start, end in zip(state['routes'], offsets[:-1], offsets[1:])]
+
+def save_keyframe(path, first_frame, state):
+    """Save the map state a shard starting at first_frame starts from, i.e. with the routes before first_frame drawn.
+    The state is a dict of NumPy arrays, which depends on the renderer."""
+    def write(file):
+        np.savez(file, first_frame=first_frame, **state)
+    write_file_atomic(path, write)
+
+def load_keyframe(path):
+    """Get the first frame and the state of a keyframe, see save_keyframe"""
+    with np.load(path) as keyframe:
+        state = {name: keyframe[name] for name in keyframe.files if name != 'first_frame'}
+        return int(keyframe['first_frame']), state
+
+def write_job(job_folder, renderer, gpx_filenames_with_dates, view, size, tile_ranges, settings, shards):
+    """Write the job description the shards are rendered from. Everything a shard needs is in it, except for the gpx files
+    and the map tiles. The gpx files are given relative to the program folder, so a machine with the same layout can find them."""
+    zoom_level, center_lat, center_lon, bounds = view
+    frames = []
+    for file_path, date in gpx_filenames_with_dates:
+        relative_path = os.path.relpath(os.path.abspath(file_path), current_directory)
+        frames.append({'path': os.path.abspath(file_path) if relative_path.startswith('..') else relative_path,
+                       'sha1': get_file_digest(file_path), 'date': date.isoformat()})
+    job = {
+        'version': JOB_VERSION,
+        'renderer': renderer,
+        'frames': frames,
+        'view': {'zoom_level': zoom_level, 'center': [center_lat, center_lon], 'bounds': list(bounds)},
+        'size': list(size),
+        'tile_ranges': [[tile_zoom, *tile_range] for tile_zoom, tile_range in tile_ranges.items()],
+        'settings': settings,
+        'shards': shards,
+    }
+    data = json.dumps(job, indent=1).encode('utf-8')
+    write_file_atomic(get_job_path(job_folder), lambda file: file.write(data))
+
+def load_job(job_folder):
+    """Load a job written by write_job. Returns the job, with its gpx files and dates as gpx_filenames_with_dates and
+    its view as a (zoom level, center lat, center lon, bounds) tuple, or None if there is no job of this version."""
+    try:
+        with open(get_job_path(job_folder), 'r', encoding='utf-8') as file:
+            job = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if job.get('version') != JOB_VERSION:
+        return None
+    job['gpx_filenames_with_dates'] = [(os.path.join(current_directory, frame['path']), datetime.fromisoformat(frame['date']))
+                                       for frame in job['frames']]
+    view = job['view']
+    job['view'] = (view['zoom_level'], view['center'][0], view['center'][1], tuple(view['bounds']))
+    job['tile_ranges'] = {tile_zoom: tuple(tile_range) for tile_zoom, *tile_range in job['tile_ranges']}
+    return job
+
+def get_changed_files(job, last_frame):
+    """Get the gpx files up to last_frame that are missing or differ from the planned ones, as a shard would draw them wrong"""
+    changed_files = []
+    for (file_path, _), frame in zip(job['gpx_filenames_with_dates'][:last_frame + 1], job['frames']):
+        if not os.path.exists(file_path) or get_file_digest(file_path) != frame['sha1']:
+            changed_files.append(file_path)
+    return changed_files
+
+def is_shard_done(job_folder, job, shard_index, output_folder=OUTPUT_FOLDER):
+    """A shard is done when all its frames are in its folder, or already merged into the output folder"""
+    frame_count = len(job['frames'])
+    shard_folder = get_shard_folder(job_folder, shard_index)
+    for frame_index in job['shards'][shard_index]['frame_indices']:
+        suffixes = ('', '_last') if frame_index == frame_count - 1 and TIMESTAMPS else ('',)
+        for suffix in suffixes:
+            if not (os.path.exists(get_frame_path(frame_index, suffix, shard_folder))
+                    or os.path.exists(get_frame_path(frame_index, suffix, output_folder))):
+                return False
+    return True
+
+def merge_shards(job_folder, job, output_folder=OUTPUT_FOLDER):
+    """Move the frames of the finished shards into the output folder. Returns the indices of the shards that are not finished,
+    whose frames are left where they are."""
+    unfinished_shards = [shard_index for shard_index in range(len(job['shards']))
+                         if not is_shard_done(job_folder, job, shard_index, output_folder)]
+    for shard_index, shard in enumerate(job['shards']):
+        if shard_index in unfinished_shards:
+            continue
+        shard_folder = get_shard_folder(job_folder, shard_index)
+        for frame_index in shard['frame_indices']:
+            for suffix in ('', '_last'):
+                shard_path = get_frame_path(frame_index, suffix, shard_folder)
+                if os.path.exists(shard_path):
+                    shutil.move(shard_path, get_frame_path(frame_index, suffix, output_folder))
+    return unfinished_shards
@@ -0,0 +1,64 @@
+# Functions related to drawing a route in parts over several video frames
+
+import numpy as np
+
+from configuration import *
+from gpx_cache import load_gpx_points
+from projection import project_to_pixels
+from simplify import get_simplified_indices
+
+
+def get_route_progress(zoom, file_path, origin_x, origin_y, timed=ROUTE_ANIMATION_TIMED):
+    """Get the simplified segments of a route as view pixel (x, y) arrays, and the progress of each point along the route from 0 to 1.
+    The progress goes by the timestamps of the points if timed and the route has them, otherwise by distance.
+    Returns the segments, the progress arrays and the point counts before and after simplifying."""
+    points = load_gpx_points(file_path)
+    pixel_segments = []
+    times = []
+    for start, end in zip(points.offsets[:-1], points.offsets[1:]):
+        kept = start + get_simplified_indices(zoom, points.latitudes[start:end], points.longitudes[start:end])
+        if len(kept) > 1:
+            pixel_segments.append(project_to_pixels(zoom, points.latitudes[kept], points.longitudes[kept], origin_x, origin_y))
+            times.append(np.asarray(points.times[kept], dtype=np.float64))
+    points_out = sum(len(pixel_x) for pixel_x, _ in pixel_segments)
+
+    # Points must move forward in time, or a part of the route could be skipped
+    all_times = np.concatenate(times) if times else np.empty(0)
+    if timed and all_times.size and not np.isnan(all_times).any() and (np.diff(all_times) > 0).all():
+        # Time between the segments counts too, like a pause
+        progress = [segment_times - times[0][0] for segment_times in times]
+    else:
+        progress = []
+        distance = 0.0
+        for pixel_x, pixel_y in pixel_segments:
+            segment_distance = distance + np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(pixel_x), np.diff(pixel_y)))))
+            progress.append(segment_distance)
+            distance = segment_distance[-1]
+    total = progress[-1][-1] if progress else 0
+    if total > 0:
+        progress = [segment_progress / total for segment_progress in progress]
+    else:
+        # A route that doesn't move appears at once
+        progress = [np.zeros(len(segment_progress)) for segment_progress in progress]
+    return pixel_segments, progress, len(points.latitudes), points_out
+
+def get_route_part(pixel_segments, progress, start, end):
+    """Get the lines of the route between the progress start and end, as (x, y) arrays.
+    The ends are interpolated, so the parts join up into the whole route. The first part should start below 0."""
+    lines = []
+    for (pixel_x, pixel_y), segment_progress in zip(pixel_segments, progress):
+        if segment_progress[-1] <= start or segment_progress[0] > end:
+            continue
+        inside = np.flatnonzero((segment_progress > start) & (segment_progress < end))
+        first = max(start, segment_progress[0])
+        last = min(end, segment_progress[-1])
+        line_x = np.concatenate(([np.interp(first, segment_progress, pixel_x)], pixel_x[inside], [np.interp(last, segment_progress, pixel_x)]))
+        line_y = np.concatenate(([np.interp(first, segment_progress, pixel_y)], pixel_y[inside], [np.interp(last, segment_progress, pixel_y)]))
+        lines.append((line_x, line_y))
+    return lines
+
+def split_route(pixel_segments, progress, part_count):
+    """Split the route into part_count parts of equal progress. Returns the lines of each part, see get_route_part."""
+    bounds = np.linspace(0, 1, part_count + 1)
+    bounds[0] = -1
+    return [get_route_part(pixel_segments, progress, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
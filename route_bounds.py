@@ -0,0 +1,86 @@
+# Functions related to summarizing route points into the map center and bounds
+
+import collections
+
+import numpy as np
+
+# Size of the buckets in degrees that route points are counted in for percentiles, about 100 meters of latitude
+SKETCH_RESOLUTION = 0.001
+
+
+class CoordinateSummary:
+    """Point count, sums, minimum and maximum of the latitudes and longitudes of route points.
+
+    Summaries of different files can be merged, so only these few numbers need to be kept, however many points there are.
+    With sketch, points are also counted per SKETCH_RESOLUTION bucket of each axis for get_center_and_bounds to leave out outliers.
+    The buckets only cover the area that has points, so they stay small too."""
+
+    def __init__(self, sketch=False):
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lon_sum = 0.0
+        self.min_lat = self.min_lon = float('inf')
+        self.max_lat = self.max_lon = float('-inf')
+        self.lat_buckets = collections.Counter() if sketch else None
+        self.lon_buckets = collections.Counter() if sketch else None
+
+    def add(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if not latitudes.size:
+            return
+        self.count += latitudes.size
+        self.lat_sum += float(latitudes.sum())
+        self.lon_sum += float(longitudes.sum())
+        self.min_lat = min(self.min_lat, float(latitudes.min()))
+        self.max_lat = max(self.max_lat, float(latitudes.max()))
+        self.min_lon = min(self.min_lon, float(longitudes.min()))
+        self.max_lon = max(self.max_lon, float(longitudes.max()))
+        if self.lat_buckets is not None:
+            add_to_buckets(self.lat_buckets, latitudes)
+            add_to_buckets(self.lon_buckets, longitudes)
+
+    def merge(self, other):
+        self.count += other.count
+        self.lat_sum += other.lat_sum
+        self.lon_sum += other.lon_sum
+        self.min_lat = min(self.min_lat, other.min_lat)
+        self.max_lat = max(self.max_lat, other.max_lat)
+        self.min_lon = min(self.min_lon, other.min_lon)
+        self.max_lon = max(self.max_lon, other.max_lon)
+        if self.lat_buckets is not None and other.lat_buckets is not None:
+            self.lat_buckets.update(other.lat_buckets)
+            self.lon_buckets.update(other.lon_buckets)
+        return self
+
+    def get_center_and_bounds(self, outlier_percent=0):
+        """Get the mean point and the bounds as (center_lat, center_lon, min_lat, max_lat, min_lon, max_lon).
+
+        With outlier_percent and a sketch, the lowest and highest outlier_percent of the latitudes and longitudes are left
+        out of the bounds and the center. The bounds are rounded outwards to SKETCH_RESOLUTION."""
+        if outlier_percent <= 0 or self.lat_buckets is None:
+            return self.lat_sum / self.count, self.lon_sum / self.count, self.min_lat, self.max_lat, self.min_lon, self.max_lon
+        center_lat, min_lat, max_lat = get_trimmed_range(self.lat_buckets, self.count, outlier_percent, self.min_lat, self.max_lat)
+        center_lon, min_lon, max_lon = get_trimmed_range(self.lon_buckets, self.count, outlier_percent, self.min_lon, self.max_lon)
+        return center_lat, center_lon, min_lat, max_lat, min_lon, max_lon
+
+
+def add_to_buckets(buckets, values):
+    bucket_indices, counts = np.unique(np.floor(values / SKETCH_RESOLUTION).astype(np.int64), return_counts=True)
+    buckets.update(dict(zip(bucket_indices.tolist(), counts.tolist())))
+
+def get_trimmed_range(buckets, count, outlier_percent, exact_min, exact_max):
+    """Get the mean, minimum and maximum of the values in the buckets between the outlier_percent and 100 - outlier_percent percentiles"""
+    bucket_indices = np.array(sorted(buckets), dtype=np.int64)
+    counts = np.array([buckets[index] for index in bucket_indices], dtype=np.int64)
+    cumulative = np.cumsum(counts)
+    trimmed = count * outlier_percent / 100
+    # First bucket reaching past the low outliers, and the last one before the high outliers
+    first = min(int(np.searchsorted(cumulative, trimmed, side='right')), len(counts) - 1)
+    last = max(first, int(np.searchsorted(cumulative, count - trimmed, side='left')))
+    kept_indices = bucket_indices[first:last + 1]
+    kept_counts = counts[first:last + 1]
+    mean = float(((kept_indices + 0.5) * kept_counts).sum() / kept_counts.sum()) * SKETCH_RESOLUTION
+    minimum = max(exact_min, float(kept_indices[0]) * SKETCH_RESOLUTION)
+    maximum = min(exact_max, float(kept_indices[-1] + 1) * SKETCH_RESOLUTION)
+    return mean, minimum, maximum
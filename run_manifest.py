@@ -0,0 +1,114 @@
+# Functions related to the run manifest, which lets a run resume and re-render only the frames affected by changed gpx files
+
+import json
+import os
+import re
+
+from configuration import *
+from gpx_cache import get_file_digest
+from util import current_directory, write_file_atomic
+
+MANIFEST_FILENAME = 'manifest.json'
+# Bump when the rendering code changes in a way that makes frames of earlier runs invalid
+MANIFEST_VERSION = 1
+FRAME_FILENAME_PATTERN = re.compile(r'^(\d{8})(_last)?\.png$')
+
+
+def get_manifest_path(output_folder=OUTPUT_FOLDER):
+    return os.path.join(current_directory, output_folder, MANIFEST_FILENAME)
+
+def get_frame_path(frame_index, suffix='', output_folder=OUTPUT_FOLDER):
+    return os.path.join(current_directory, output_folder, str(frame_index).zfill(8) + suffix + '.png')
+
+def get_sub_frames(renderer):
+    """Number of parts each route is drawn in, see ROUTE_ANIMATION_FRAMES"""
+    return max(1, ROUTE_ANIMATION_FRAMES) if OUTPUT_VIDEO and renderer != 'html' else 1
+
+def get_render_settings(renderer, zoom_level, center_lat, center_lon, bounds, map_size=(MAP_WIDTH, MAP_HEIGHT)):
+    """Get the settings that change how the frames look. Frames of a run with different settings can't be reused."""
+    return {
+        'renderer': renderer,
+        'map_size': list(map_size),
+        'zoom_level': zoom_level,
+        'center': [center_lat, center_lon],
+        'bounds': list(bounds),
+        'single_page_map': SINGLE_PAGE_MAP,
+        'timestamps': TIMESTAMPS,
+        'year_colors': {str(year): color for year, color in YEAR_COLORS.items()},
+        'alidade_map': ALIDADE_MAP,
+        'tile_server_url': TILE_SERVER_URL,
+        'simplify_tolerance': SIMPLIFY_TOLERANCE,
+        'heatmap': [HEATMAP_SATURATION, HEATMAP_COLORS, HEATMAP_YEAR_COLORS] if renderer == 'heatmap' else None,
+        # Routes drawn in parts can differ from routes drawn at once by a few pixels where the parts join
+        'route_animation': [ROUTE_ANIMATION_FRAMES, ROUTE_ANIMATION_TIMED] if get_sub_frames(renderer) > 1 else None,
+    }
+
+def create_manifest(gpx_filenames_with_dates, settings):
+    """Describe a run: the render settings and the gpx file content and date behind each frame, in frame order"""
+    frames = [{'file': os.path.basename(file_path), 'sha1': get_file_digest(file_path), 'date': date.isoformat()}
+              for file_path, date in gpx_filenames_with_dates]
+    return {'version': MANIFEST_VERSION, 'settings': settings, 'frames': frames}
+
+def load_manifest(output_folder=OUTPUT_FOLDER):
+    try:
+        with open(get_manifest_path(output_folder), 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(manifest, output_folder=OUTPUT_FOLDER):
+    data = json.dumps(manifest, indent=1).encode('utf-8')
+    write_file_atomic(get_manifest_path(output_folder), lambda file: file.write(data))
+
+def get_previous_view(center_lat, center_lon, min_lat, max_lat, min_lon, max_lon, output_folder=OUTPUT_FOLDER):
+    """The map is centered on the mean of all points, so new routes would move the map and make every earlier frame invalid.
+    Keep the center and bounds of the previous run if all routes still fit in its bounds. Returns the center and bounds to use."""
+    old_manifest = load_manifest(output_folder)
+    try:
+        if old_manifest is not None and old_manifest['version'] == MANIFEST_VERSION:
+            old_center = old_manifest['settings']['center']
+            old_min_lat, old_max_lat, old_min_lon, old_max_lon = old_manifest['settings']['bounds']
+            if old_min_lat <= min_lat and max_lat <= old_max_lat and old_min_lon <= min_lon and max_lon <= old_max_lon:
+                return old_center[0], old_center[1], old_min_lat, old_max_lat, old_min_lon, old_max_lon
+    except (KeyError, TypeError, ValueError):
+        pass
+    return center_lat, center_lon, min_lat, max_lat, min_lon, max_lon
+
+def get_first_invalid_frame(old_manifest, manifest):
+    """Frames are cumulative, so a frame of the old run is valid only if it and every frame before it are unchanged"""
+    if (old_manifest is None or old_manifest.get('version') != MANIFEST_VERSION
+            or old_manifest.get('settings') != json.loads(json.dumps(manifest['settings']))):
+        return 0
+    first_invalid = 0
+    for old_frame, frame in zip(old_manifest['frames'], manifest['frames']):
+        if old_frame != frame:
+            break
+        first_invalid += 1
+    return first_invalid
+
+def is_frame_done(frame_index, frame_count, output_folder=OUTPUT_FOLDER):
+    """Frames are written atomically, so an existing file is complete. The last frame also needs its year-only copy."""
+    if not os.path.exists(get_frame_path(frame_index, output_folder=output_folder)):
+        return False
+    return (frame_index != frame_count - 1 or not TIMESTAMPS
+            or os.path.exists(get_frame_path(frame_index, '_last', output_folder)))
+
+def prepare_frames(manifest, resume, output_folder=OUTPUT_FOLDER):
+    """Delete the frames in the output folder that the run will not reuse, and save the manifest of the run.
+    With resume, frames up to the first new or changed gpx file are kept, and so are frames an interrupted run already finished.
+    Returns the indices of the frames that have to be rendered."""
+    frame_count = len(manifest['frames'])
+    first_invalid = get_first_invalid_frame(load_manifest(output_folder), manifest) if resume else 0
+
+    for filename in os.listdir(os.path.join(current_directory, output_folder)):
+        match = FRAME_FILENAME_PATTERN.match(filename)
+        if not match:
+            continue
+        frame_index = int(match.group(1))
+        # A year-only copy is only valid for the last frame
+        if frame_index >= first_invalid or (match.group(2) and frame_index != frame_count - 1):
+            os.unlink(os.path.join(current_directory, output_folder, filename))
+
+    # The manifest is saved before rendering, so an interrupted run can be resumed
+    save_manifest(manifest, output_folder)
+    return [frame_index for frame_index in range(frame_count) if not is_frame_done(frame_index, frame_count, output_folder)]
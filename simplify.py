@@ -0,0 +1,90 @@
+# Functions related to simplifying routes before drawing them
+
+import numpy as np
+
+from configuration import *
+from projection import project_to_pixels
+
+
+def deduplicate_pixels(pixel_x, pixel_y, grid_size):
+    """Get a mask that drops consecutive points falling in the same grid_size pixel cell. The first and last points are always kept."""
+    keep = np.ones(len(pixel_x), dtype=bool)
+    if len(pixel_x) > 2:
+        cell_x = np.floor(pixel_x / grid_size)
+        cell_y = np.floor(pixel_y / grid_size)
+        keep[1:] = (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])
+        keep[-1] = True
+    return keep
+
+def douglas_peucker(pixel_x, pixel_y, tolerance):
+    """Get a mask of the points that keep the line within tolerance pixels of the original (Douglas-Peucker).
+
+    Instead of recursing range by range, every open range is split at once in each round, so the work per round is a few
+    NumPy operations over the whole segment and the number of rounds only grows with the recursion depth."""
+    point_count = len(pixel_x)
+    keep = np.zeros(point_count, dtype=bool)
+    if point_count == 0:
+        return keep
+    keep[0] = keep[-1] = True
+
+    # Points whose range still has to be checked
+    open_points = np.ones(point_count, dtype=bool)
+    open_points[[0, -1]] = False
+
+    while open_points.any():
+        kept = np.flatnonzero(keep)
+        candidates = np.flatnonzero(open_points)
+        range_ids = np.searchsorted(kept, candidates) - 1
+        start = kept[range_ids]
+        end = kept[range_ids + 1]
+
+        # Distances of the points to the line segment between the kept points around them
+        x = pixel_x[candidates] - pixel_x[start]
+        y = pixel_y[candidates] - pixel_y[start]
+        dx = pixel_x[end] - pixel_x[start]
+        dy = pixel_y[end] - pixel_y[start]
+        length_squared = dx * dx + dy * dy
+        t = np.clip(np.divide(x * dx + y * dy, length_squared, out=np.zeros_like(x), where=length_squared > 0), 0, 1)
+        distances_squared = (x - t * dx) ** 2 + (y - t * dy) ** 2
+
+        # Farthest point of each range (candidates are sorted, so each range is one contiguous group)
+        group_starts = np.flatnonzero(np.diff(range_ids, prepend=-1))
+        group_ids = np.cumsum(np.diff(range_ids, prepend=-1) != 0) - 1
+        max_distances = np.maximum.reduceat(distances_squared, group_starts)
+        is_farthest = distances_squared == max_distances[group_ids]
+        farthest_groups, first_farthest = np.unique(group_ids[is_farthest], return_index=True)
+        farthest = candidates[np.flatnonzero(is_farthest)[first_farthest]]
+
+        # Ranges that are close enough are done, the others are split at their farthest point
+        split = max_distances[farthest_groups] > tolerance * tolerance
+        keep[farthest[split]] = True
+        open_points[farthest[split]] = False
+        open_points[candidates[max_distances[group_ids] <= tolerance * tolerance]] = False
+    return keep
+
+def get_simplified_indices(zoom, latitudes, longitudes, tolerance=SIMPLIFY_TOLERANCE):
+    """Get the indices of the points simplify_segment keeps"""
+    if tolerance <= 0 or len(latitudes) < 3:
+        return np.arange(len(latitudes))
+    pixel_x, pixel_y = project_to_pixels(zoom, latitudes, longitudes)
+
+    deduplicated = np.flatnonzero(deduplicate_pixels(pixel_x, pixel_y, tolerance))
+    return deduplicated[douglas_peucker(pixel_x[deduplicated], pixel_y[deduplicated], tolerance)]
+
+def simplify_segment(zoom, latitudes, longitudes, tolerance=SIMPLIFY_TOLERANCE):
+    """Simplify a segment so that, drawn at the zoom level, it stays within about tolerance pixels of the original"""
+    if tolerance <= 0 or len(latitudes) < 3:
+        return latitudes, longitudes
+    kept = get_simplified_indices(zoom, latitudes, longitudes, tolerance)
+    return latitudes[kept], longitudes[kept]
+
+def simplify_route(zoom, segments, tolerance=SIMPLIFY_TOLERANCE):
+    """Simplify the (latitudes, longitudes) segments of a route. Returns the simplified segments, and the point counts before and after."""
+    simplified = [simplify_segment(zoom, latitudes, longitudes, tolerance) for latitudes, longitudes in segments]
+    points_in = sum(len(latitudes) for latitudes, _ in segments)
+    points_out = sum(len(latitudes) for latitudes, _ in simplified)
+    return simplified, points_in, points_out
+
+def print_simplification(points_in, points_out):
+    if points_in:
+        print(f'Routes simplified from {points_in} to {points_out} points ({100 * (1 - points_out / points_in):.1f}% removed).\n')
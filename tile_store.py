@@ -0,0 +1,151 @@
+# Functions related to the persistent SQLite store of map tiles and the cache of stitched base mosaics
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from configuration import *
+from instrumentation import add_bytes
+from util import current_directory, write_file_atomic
+
+TILE_STORE_VERSION = 1
+# Stitched base mosaics kept in TILE_MOSAIC_FOLDER, the least recently used are deleted beyond this
+MAX_MOSAICS = 20
+
+# Like MBTiles, the tiles table has the png data of a tile by zoom level and column. Unlike MBTiles, rows are counted
+# from the top like in the tile urls, and tiles of several providers can be kept side by side.
+# last_used is for evicting the least recently used tiles when the store grows beyond TILE_STORE_MAX_MB.
+TILE_STORE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS tiles (
+        provider TEXT NOT NULL,
+        zoom_level INTEGER NOT NULL,
+        tile_column INTEGER NOT NULL,
+        tile_row INTEGER NOT NULL,
+        tile_data BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (provider, zoom_level, tile_column, tile_row)
+    );
+    CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used);
+    '''
+
+
+def open_tile_store():
+    """Open the store at TILE_STORE, creating it if needed. A store of an older version is started over."""
+    store_path = os.path.join(current_directory, TILE_STORE)
+    # Shards and output targets may read the store from several processes at once
+    connection = sqlite3.connect(store_path, timeout=60)
+    connection.execute('PRAGMA journal_mode = WAL')
+    if connection.execute('PRAGMA user_version').fetchone()[0] != TILE_STORE_VERSION:
+        connection.executescript('DROP TABLE IF EXISTS tiles;')
+        connection.executescript(TILE_STORE_SCHEMA)
+        connection.execute(f'PRAGMA user_version = {TILE_STORE_VERSION}')
+    return connection
+
+def get_provider_key(provider):
+    # The url template doesn't contain the api key, so it's the same for everyone using the provider
+    return provider['url']
+
+def get_range_condition(provider_key, zoom, min_x, max_x, min_y, max_y):
+    return ('provider = ? AND zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?',
+            (provider_key, zoom, min_x, max_x, min_y, max_y))
+
+def get_missing_tiles(connection, provider_key, zoom, tiles):
+    """Get the (x, y) tiles that are not in the store, or are older than TILE_MAX_AGE_DAYS"""
+    xs = [x for x, _ in tiles]
+    ys = [y for _, y in tiles]
+    condition, parameters = get_range_condition(provider_key, zoom, min(xs), max(xs), min(ys), max(ys))
+    oldest_fetch = time.time() - TILE_MAX_AGE_DAYS * 24 * 60 * 60
+    fresh_tiles = {(x, y) for x, y in connection.execute(
+        f'SELECT tile_column, tile_row FROM tiles WHERE {condition} AND fetched_at >= ?', parameters + (oldest_fetch,))}
+    return [tile for tile in tiles if tile not in fresh_tiles]
+
+def put_tile(connection, provider_key, zoom, x, y, tile_data):
+    now = time.time()
+    connection.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (provider_key, zoom, x, y, tile_data, len(tile_data), now, now))
+    add_bytes(written=len(tile_data))
+
+def mark_tiles_used(connection, provider_key, zoom, min_x, max_x, min_y, max_y):
+    condition, parameters = get_range_condition(provider_key, zoom, min_x, max_x, min_y, max_y)
+    connection.execute(f'UPDATE tiles SET last_used = ? WHERE {condition}', (time.time(),) + parameters)
+
+def evict_tiles(connection, max_bytes=None):
+    """Delete the least recently used tiles until the store is at most TILE_STORE_MAX_MB. Returns the number of tiles deleted."""
+    if max_bytes is None:
+        max_bytes = TILE_STORE_MAX_MB * 1024 * 1024
+    # Running total of the sizes from the most recently used tile down
+    cursor = connection.execute('''
+        DELETE FROM tiles WHERE rowid IN (
+            SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC, rowid) AS kept_bytes FROM tiles)
+            WHERE kept_bytes > ?)''', (max_bytes,))
+    return cursor.rowcount
+
+def get_tile_data(connection, provider_key, zoom, x, y):
+    row = connection.execute('SELECT tile_data FROM tiles WHERE provider = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                             (provider_key, zoom, x, y)).fetchone()
+    if row is None:
+        return None
+    add_bytes(read=len(row[0]))
+    return row[0]
+
+def export_tiles(connection, provider_key, zoom, min_x, max_x, min_y, max_y, tile_folder):
+    """Write the tiles of the range as loose files into tile_folder, for the html maps. Existing files are rewritten only if
+    the tile in the store is newer. Returns the number of files written."""
+    condition, parameters = get_range_condition(provider_key, zoom, min_x, max_x, min_y, max_y)
+    written_files = 0
+    for x, y, tile_data, fetched_at in connection.execute(f'SELECT tile_column, tile_row, tile_data, fetched_at FROM tiles WHERE {condition}',
+                                                          parameters):
+        tile_path = os.path.join(tile_folder, str(zoom), str(x), f'{y}.png')
+        if os.path.exists(tile_path) and os.path.getmtime(tile_path) >= fetched_at:
+            continue
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        # The html maps of another run may be loading the tile at the same time
+        write_file_atomic(tile_path, lambda file: file.write(tile_data))
+        written_files += 1
+    return written_files
+
+
+def get_mosaic_path(connection, provider_key, zoom, tile_zoom, tile_range, origin_x, origin_y, width, height):
+    """Get the path of the cached mosaic of a view. The path changes with the tiles of the view in the store,
+    so a mosaic is never used after one of its tiles has been downloaded again."""
+    condition, parameters = get_range_condition(provider_key, tile_zoom, *tile_range)
+    tile_count, last_fetch = connection.execute(f'SELECT COUNT(*), MAX(fetched_at) FROM tiles WHERE {condition}', parameters).fetchone()
+    key = json.dumps([TILE_STORE_VERSION, provider_key, zoom, origin_x, origin_y, width, height, tile_count, last_fetch])
+    return os.path.join(current_directory, TILE_MOSAIC_FOLDER, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+def load_mosaic(mosaic_path):
+    """Get a cached mosaic as a read-only memory-mapped height x width x 3 array, or None if it isn't cached"""
+    try:
+        mosaic = np.load(mosaic_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    # The modification time tells which mosaics were used least recently
+    os.utime(mosaic_path)
+    add_bytes(read=mosaic.nbytes)
+    return mosaic
+
+def save_mosaic(mosaic_path, image):
+    """Cache the decoded RGB image of a mosaic as a raw .npy file, and delete the least recently used mosaics beyond MAX_MOSAICS"""
+    mosaic_folder = os.path.dirname(mosaic_path)
+    os.makedirs(mosaic_folder, exist_ok=True)
+    temp_path = f'{mosaic_path}.{os.getpid()}.tmp.npy'
+    mosaic = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.uint8, shape=(image.height, image.width, 3))
+    mosaic[:] = np.asarray(image.convert('RGB'))
+    mosaic.flush()
+    del mosaic
+    os.replace(temp_path, mosaic_path)
+    add_bytes(written=image.width * image.height * 3)
+
+    mosaic_paths = [os.path.join(mosaic_folder, filename) for filename in os.listdir(mosaic_folder) if filename.endswith('.npy')
+                    and not filename.endswith('.tmp.npy')]
+    for old_path in sorted(mosaic_paths, key=os.path.getmtime, reverse=True)[MAX_MOSAICS:]:
+        try:
+            os.unlink(old_path)
+        except OSError:
+            pass
@@ -0,0 +1,129 @@
+# Functions related to drawing the dates and the year legend on the frames
+
+import functools
+import os
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from configuration import *
+from instrumentation import add_bytes, instrumented
+from util import write_file_atomic
+
+FONT_SIZE = 35
+LINE_HEIGHT = 40
+MARGIN = 10
+STROKE_WIDTH = 1
+STROKE_COLOR = 'black'
+
+
+@functools.lru_cache(maxsize=None)
+def get_font():
+    try:
+        return ImageFont.truetype('arial.ttf', FONT_SIZE)
+    except IOError:
+        return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=None)
+def get_glyph(character):
+    """Render a character of the glyph atlas. Returns the stroke and fill masks, their offset from the text origin and the advance width."""
+    font = get_font()
+    left, top, right, bottom = font.getbbox(character, stroke_width=STROKE_WIDTH)
+    size = (max(right - left, 1), max(bottom - top, 1))
+    stroke_mask = Image.new('L', size)
+    ImageDraw.Draw(stroke_mask).text((-left, -top), character, font=font, fill=255, stroke_width=STROKE_WIDTH, stroke_fill=255)
+    fill_mask = Image.new('L', size)
+    ImageDraw.Draw(fill_mask).text((-left, -top), character, font=font, fill=255)
+    return stroke_mask, fill_mask, (left, top), font.getlength(character)
+
+def get_text_masks(text):
+    """Put the text together from the glyph atlas. Returns the stroke and fill masks and their offset from the text origin."""
+    glyphs = []
+    x = 0
+    for character in text:
+        stroke_mask, fill_mask, (left, top), advance = get_glyph(character)
+        glyphs.append((stroke_mask, fill_mask, round(x) + left, top))
+        x += advance
+
+    min_x = min(glyph_x for _, _, glyph_x, _ in glyphs)
+    min_y = min(glyph_y for _, _, _, glyph_y in glyphs)
+    size = (max(glyph_x + mask.width for mask, _, glyph_x, _ in glyphs) - min_x,
+            max(glyph_y + mask.height for mask, _, _, glyph_y in glyphs) - min_y)
+    text_masks = (Image.new('L', size), Image.new('L', size))
+    for *glyph_masks, glyph_x, glyph_y in glyphs:
+        box = (glyph_x - min_x, glyph_y - min_y, glyph_x - min_x + glyph_masks[0].width, glyph_y - min_y + glyph_masks[0].height)
+        for text_mask, glyph_mask in zip(text_masks, glyph_masks):
+            # Neighbouring glyphs can overlap, keep the stronger coverage
+            text_mask.paste(ImageChops.lighter(text_mask.crop(box), glyph_mask), box)
+    return text_masks[0], text_masks[1], (min_x, min_y)
+
+@functools.lru_cache(maxsize=256)
+def get_text_overlay(text, color):
+    """Get an RGBA overlay of outlined text. Returns the overlay and its offset from the text origin."""
+    stroke_mask, fill_mask, offset = get_text_masks(text)
+    overlay = Image.new('RGBA', stroke_mask.size, (0, 0, 0, 0))
+    for layer_color, mask in ((STROKE_COLOR, stroke_mask), (color, fill_mask)):
+        layer = Image.new('RGBA', mask.size, layer_color)
+        layer.putalpha(mask)
+        overlay.alpha_composite(layer)
+    return overlay, offset
+
+@functools.lru_cache(maxsize=None)
+def get_legend_overlay(year):
+    """Get an RGBA overlay with the legend of the years before the year, placed from the top left corner of the frame.
+    Returns the overlay (None if there are no earlier years) and the y coordinate below it."""
+    legend_years = range(min(YEAR_COLORS.keys()), year) if YEAR_COLORS else []
+    if not legend_years:
+        return None, MARGIN
+
+    lines = []
+    y = MARGIN
+    for legend_year in legend_years:
+        overlay, (offset_x, offset_y) = get_text_overlay(str(legend_year), YEAR_COLORS.get(legend_year, '#000000'))
+        lines.append((overlay, (MARGIN + offset_x, y + offset_y)))
+        y += LINE_HEIGHT
+
+    size = (max(line_x + overlay.width for overlay, (line_x, _) in lines), max(line_y + overlay.height for overlay, (_, line_y) in lines))
+    legend = Image.new('RGBA', size, (0, 0, 0, 0))
+    for overlay, position in lines:
+        legend.alpha_composite(overlay, position)
+    return legend, y
+
+@instrumented('timestamp')
+def draw_timestamp(image, dt, year_only = False):
+    """Draw the date (or just the year) and the legend of earlier years on an image"""
+    year = dt.year
+    legend, y = get_legend_overlay(year)
+    if legend is not None:
+        image.paste(legend, (0, 0), legend)
+
+    stamp = str(year) if year_only else dt.strftime('%Y-%m-%d')
+    overlay, (offset_x, offset_y) = get_text_overlay(stamp, YEAR_COLORS.get(year, '#000000'))
+    image.paste(overlay, (MARGIN + offset_x, y + offset_y), overlay)
+
+@instrumented('png_write')
+def save_png(image, path):
+    # Written atomically, so an existing frame is always complete even if a run is interrupted
+    write_file_atomic(path, lambda file: image.save(file, 'PNG'))
+    add_bytes(written=os.path.getsize(path))
+
+def save_stamped_frame(image, output_folder, frame_index, date, is_last_frame=False):
+    """Save a frame as a png, stamped with the date if TIMESTAMPS is set. The image itself is left as it is.
+    The last frame also gets a _last copy stamped with just the year. Returns the paths of the saved images."""
+    base_path = os.path.join(output_folder, str(frame_index).zfill(8))
+    if not TIMESTAMPS:
+        save_png(image, base_path + '.png')
+        return [base_path + '.png']
+
+    image_paths = []
+    # The year-only copy is saved first, so that a saved last frame always has its copy
+    if is_last_frame:
+        stamped_image = image.copy()
+        draw_timestamp(stamped_image, date, year_only=True)
+        save_png(stamped_image, base_path + '_last.png')
+        image_paths.append(base_path + '_last.png')
+
+    stamped_image = image.copy()
+    draw_timestamp(stamped_image, date)
+    save_png(stamped_image, base_path + '.png')
+    image_paths.insert(0, base_path + '.png')
+    return image_paths
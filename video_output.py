@@ -0,0 +1,144 @@
+# Functions related to writing the timelapse straight into a video file with ffmpeg
+
+import io
+import subprocess
+
+from PIL import Image
+
+from configuration import *
+from instrumentation import add_bytes
+from run_manifest import get_frame_path
+from timestamps import draw_timestamp, save_png
+from util import create_progress_bar_string
+
+
+class VideoWriter:
+    """Pipes frames into an ffmpeg process as raw RGB. Each frame is repeated to show it for the given duration."""
+    def __init__(self, output_path, fps=VIDEO_FPS):
+        self.output_path = output_path
+        self.fps = fps
+        self.process = None
+        self.size = None
+        self.video_time = 0.0
+        self.written_frames = 0
+
+    def start(self, size):
+        self.size = size
+        command = [
+            FFMPEG_PATH, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{size[0]}x{size[1]}', '-r', str(self.fps), '-i', '-',
+            # yuv420p needs even dimensions
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', '18',
+            self.output_path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def add_frame(self, image, duration):
+        if self.process is None:
+            self.start(image.size)
+        if image.size != self.size:
+            image = image.resize(self.size)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        frame_data = image.tobytes()
+
+        # Count repeats from the total video time, so rounding doesn't add up over thousands of frames
+        repeats = round((self.video_time + duration) * self.fps) - self.written_frames
+        self.video_time += duration
+        for _ in range(repeats):
+            self.process.stdin.write(frame_data)
+        self.written_frames += repeats
+        add_bytes(written=len(frame_data) * repeats)
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            print(f'ffmpeg failed to write {self.output_path}')
+
+
+def merge_reused_frames(frames, reused_frames, frame_count, sub_frames=1, output_folder=OUTPUT_FOLDER):
+    """Put the rendered (index, frame) pairs and the frames reused from an earlier run back in frame order.
+    Reused frames are given as the path of their already stamped image. Rendered frames come sub_frames times each."""
+    frames = iter(frames)
+    for frame_index in range(frame_count):
+        if frame_index in reused_frames:
+            yield frame_index, get_frame_path(frame_index, output_folder=output_folder)
+        else:
+            for _ in range(sub_frames):
+                yield next(frames)
+
+def write_video(frames, gpx_filenames_with_dates, video_path, reused_frames=(), sub_frames=1, output_folder=OUTPUT_FOLDER):
+    """Stamp the (index, image or png data) frames, which must come in order, and stream them into a video.
+    The images are also written into output_folder if WRITE_PNG_FILES is set.
+    The frames in reused_frames are left out of frames, and are read from the images an earlier run wrote instead.
+    With sub_frames, every rendered frame index comes that many times with the route drawn in parts (see generate_native_frames).
+    The parts share the frame's FRAME_DURATION, and only the last one, with the whole route, is a frame of its own."""
+    writer = VideoWriter(video_path)
+    last_frame = None
+    hold_frame = None
+    image_paths = []
+    frame_count = len(gpx_filenames_with_dates)
+    parts_done = 0
+
+    for frame_index, frame in merge_reused_frames(frames, set(reused_frames), frame_count, sub_frames, output_folder):
+        if frame is None:
+            print(f'Frame {frame_index} is missing from the video.')
+            continue
+        if isinstance(frame, str):
+            image = Image.open(frame).convert('RGB')
+            image_paths.append(frame)
+            if frame_index == frame_count - 1:
+                # The year-only copy of the last frame is already stamped as well
+                hold_path = get_frame_path(frame_index, '_last', output_folder) if TIMESTAMPS else frame
+                hold_frame = Image.open(hold_path).convert('RGB')
+                if TIMESTAMPS:
+                    image_paths.append(hold_path)
+            writer.add_frame(image, FRAME_DURATION)
+            continue
+
+        date = gpx_filenames_with_dates[frame_index][1]
+        parts_done += 1
+        if parts_done < sub_frames:
+            # A part of a route is only written into the video, so the image needs copying only for the timestamp
+            if TIMESTAMPS:
+                frame = frame.copy()
+                draw_timestamp(frame, date)
+            writer.add_frame(frame, FRAME_DURATION / sub_frames)
+            continue
+        parts_done = 0
+
+        if isinstance(frame, bytes):
+            frame = Image.open(io.BytesIO(frame))
+        # The renderers draw the next routes on the same image, so the timestamp goes on the one working copy of it.
+        # Nothing is drawn after the last frame, so the frame itself is kept for the hold frame.
+        image = frame.convert('RGB')
+        last_frame = frame
+
+        if TIMESTAMPS:
+            draw_timestamp(image, date)
+        if WRITE_PNG_FILES:
+            image_path = get_frame_path(frame_index, output_folder=output_folder)
+            save_png(image, image_path)
+            image_paths.append(image_path)
+        writer.add_frame(image, FRAME_DURATION / sub_frames)
+
+        progress_bar = create_progress_bar_string(frame_index + 1, frame_count, width=50)
+        print(f'\r{progress_bar} {frame_index + 1} / {frame_count}       ', end='')
+
+    # Hold the last frame, stamped with just the year
+    if hold_frame is None and last_frame is not None:
+        hold_frame = last_frame.convert('RGB')
+        if TIMESTAMPS:
+            draw_timestamp(hold_frame, gpx_filenames_with_dates[-1][1], year_only=True)
+            if WRITE_PNG_FILES:
+                hold_path = get_frame_path(frame_count - 1, '_last', output_folder)
+                save_png(hold_frame, hold_path)
+                image_paths.append(hold_path)
+    if hold_frame is not None:
+        writer.add_frame(hold_frame, LAST_FRAME_DURATION)
+
+    writer.close()
+    print('\r                                                                                                 \r')
+    return image_paths
@@ -1,145 +1,399 @@
-# Creates timelapse images out of GPX files. 
-# The script generates HTML pages with folium/gpxpy, then captures them into images with Selenium/Chrome.
-# User can then make a video of the screenshots using e.g. DaVinci Resolve.
-
-# Put .gpx files in the 'input' folder.
-
-# Requires pip install folium, gpxpy, pillow, selenium
-
-
-import os
-import shutil
-import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from datetime import datetime
-
-import folium
-import gpxpy
-from folium import TileLayer
-
-from configuration import *
-from gpx_files import get_center_and_bounds, get_gpx_filenames_and_dates
-from image_files import add_timestamp_to_image, add_timestamp_to_image_task, capture_chunk, save_map
-from map_tiles import download_tiles, get_zoom_level, get_tile_bounds
-from util import clear_directory, current_directory, create_progress_bar_string, clear_screen
-
-
-def main():
-    clear_screen()
-    print('-- GPX timelapse creator --\n')
-
-    if CLEAR_OUTPUT_FOLDER:
-        clear_directory(OUTPUT_FOLDER)
-    clear_directory('html_maps')
-        
-    gpx_files = [os.path.join(INPUT_FOLDER, f) for f in os.listdir(INPUT_FOLDER) if f.endswith('.gpx')]
-    if not gpx_files:
-        print('Error: no gpx files found in input folder.')
-        sys.exit(1)
-    else:
-        print(f'{len(gpx_files)} gpx files found.\n')
-   
-    print(f'Searching for map bounds.')
-    center_lat, center_lon, min_lat, max_lat, min_lon, max_lon = get_center_and_bounds(gpx_files, number_of_workers)
-    if VERBOSE_OUTPUT:
-        print(f'latitude {min_lat} to {max_lat}\nlongitude {min_lon} to {max_lon}')
-
-    zoom_level = get_zoom_level(min_lat, max_lat, min_lon, max_lon, MAP_WIDTH, MAP_HEIGHT)
-    min_x, max_x, min_y, max_y = get_tile_bounds(zoom_level, min_lat, max_lat, min_lon, max_lon)
-    if VERBOSE_OUTPUT:
-        print(f'map zoom level {zoom_level}\ntiles x {min_x} to {max_x}\ntiles y {min_y} to {max_y}')
-
-    print(f'\nDownloading map tiles.')
-    download_tiles(zoom_level, min_x, max_x, min_y, max_y, STADIA_API_KEY)
-
-    folium_map = folium.Map(location=[center_lat, center_lon], zoom_start=zoom_level)  
-    # folium_map.fit_bounds([[min_lat, min_lon], [max_lat, max_lon]])
-
-    if ALIDADE_MAP:
-        TileLayer(
-            tiles="map_tiles/{z}/{x}/{y}.png",
-            attr="&copy; <a href='https://stadiamaps.com/'>Stadia Maps</a>, &copy; <a href='https://openmaptiles.org/'>OpenMapTiles</a> &copy; <a href='http://openstreetmap.org/copyright'>OpenStreetMap contributors</a>",
-            name='Alidade Smooth',
-            control=False
-        ).add_to(folium_map)
-         
-    if VERBOSE_OUTPUT:
-        print('\nGetting date and time in gpx files.')
-    gpx_filenames_with_dates = get_gpx_filenames_and_dates()  # list of tuples (filename, date)
-
-    print('Creating html maps.')
-    current_map = 0
-    html_paths = []
-    start_time = datetime.now()
-    for file_and_date in gpx_filenames_with_dates:
-        date = file_and_date[1]
-        year = date.year
-        file_path = file_and_date[0]
-        color = YEAR_COLORS.get(year, '#000000')
-        with open(file_path, 'r') as gpx_file:
-            gpx = gpxpy.parse(gpx_file)               
-            for track in gpx.tracks:
-                for segment in track.segments:
-                    segment_coords = [(point.latitude, point.longitude) for point in segment.points]
-                    folium.PolyLine(segment_coords, color=color, weight=3.5, opacity=1).add_to(folium_map)
-        
-        output_filename = str(current_map).zfill(8) + '.html'
-        output_path = os.path.join(current_directory, 'html_maps', output_filename)
-        html_paths.append(output_path)
-        save_map(folium_map, output_path)
-        progress_bar = create_progress_bar_string(current_map + 1, len(gpx_filenames_with_dates), width=50)
-        print(f'\r{progress_bar} {current_map + 1} / {len(gpx_filenames_with_dates)}       ', end ='')
-        current_map += 1
-    print('\r                                                                                                 \r')
-       
-    print('Capturing html maps into images.')
-    chunks = [html_paths[i::number_of_workers] for i in range(number_of_workers)]
-    date_chunks = [gpx_filenames_with_dates[i::number_of_workers] for i in range(number_of_workers)]
-    
-    with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
-        futures = []
-        for chunk, date_chunk in zip(chunks, date_chunks):
-            future = executor.submit(capture_chunk, chunk, [date[1] for date in date_chunk])
-            futures.append(future)
-
-        for future in futures:
-            future.result()
-
-    print("\r                                          ")
-    
-    print('Timestamping images')
-    image_paths = []
-    for html_path in html_paths:
-        filename = os.path.basename(html_path)[:-4] + 'png'
-        image_path = os.path.join(current_directory, OUTPUT_FOLDER, filename)
-        image_paths.append(image_path)
-
-    tasks = [(image_path, gpx_filenames_with_dates[index][1]) for index, image_path in enumerate(image_paths)]
-
-    # Create a copy of the last image, and stamp it with just the year (not displaying month or day)
-    last_image_path = image_paths[-1]
-    copied_filename = os.path.basename(last_image_path)[:-4] + '_last.png'
-    copied_image_path = os.path.join(os.path.dirname(last_image_path), copied_filename)
-    shutil.copyfile(last_image_path, copied_image_path)
-        
-    with ProcessPoolExecutor() as executor:
-        futures = {executor.submit(add_timestamp_to_image_task, task): task for task in tasks}
-        for index, _ in enumerate(as_completed(futures)):
-            progress_bar = create_progress_bar_string(index + 1, len(image_paths), width=50)
-            print(f'\r{progress_bar} {index + 1} / {len(image_paths)}       ', end='')
-    
-    add_timestamp_to_image(copied_image_path, gpx_filenames_with_dates[-1][1], year_only=True)  # Stamp an extra image with just the year (no month or day in the last image)
-
-    # Create images.txt for use with ffmpeg
-    textfile_path = os.path.join(current_directory, 'output', 'images.txt')
-    with open(textfile_path, "w", encoding = 'utf-8') as f:
-        for image_path in image_paths:
-            f.write(f"file '{image_path}'\n")
-        f.write(f"file '{copied_image_path}'")
-    
-    print('\r                                                                                                                       \r')
-    
-    print('All done ^_^ _b')
-
-if __name__ == '__main__':
-    main()
+# Creates timelapse images out of GPX files. 
+# The script generates HTML pages with folium, then captures them into images with Selenium/Chrome.
+# User can then make a video of the screenshots using e.g. DaVinci Resolve, or set OUTPUT_VIDEO to have ffmpeg make it directly.
+
+# Put .gpx files in the 'input' folder.
+
+# Requires pip install folium, numpy, pillow, selenium
+# Alternatively, the 'native' renderer draws the routes straight onto the map tiles with pillow, without a browser,
+# and the 'heatmap' renderer colors the map tiles by how many routes pass through each pixel.
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import folium
+
+from activity_catalog import get_selected_activities
+from capture_pool import capture_frames, capture_html_frames
+from configuration import *
+from folium_maps import add_single_page_tracks, create_folium_map
+from gpx_files import get_center_and_bounds, get_gpx_filenames_and_dates, get_segment_arrays_from_gpx
+from instrumentation import print_run_report, stage, start_run_report, write_run_report
+from image_files import save_map
+from map_tiles import download_tiles
+from native_map import render_native_frames
+from output_targets import (get_frame_generator, get_image_paths, get_output_targets, get_target_view, get_tile_ranges, render_targets,
+                            write_image_list)
+from render_shards import (get_changed_files, get_keyframe_path, get_last_frame, get_segments_state, get_shard_folder, get_shards,
+                           get_state_segments, load_job, load_keyframe, merge_shards, save_keyframe, write_job)
+from run_manifest import create_manifest, get_render_settings, is_frame_done, prepare_frames
+from simplify import print_simplification, simplify_route
+from video_output import write_video
+from util import clear_directory, current_directory, create_progress_bar_string, clear_screen
+
+
+def create_html_maps(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices, keyframe=None, keyframe_paths=None):
+    """Create the cumulative html maps for the frame indices. The routes up to the last frame index are added to the map,
+    but only those frames are saved. Like generate_native_frames, the map starts from a keyframe if given, and the routes
+    before each first frame in keyframe_paths are saved as a keyframe."""
+    frame_indices = set(frame_indices)
+    keyframe_paths = keyframe_paths or {}
+    last_frame = get_last_frame(len(gpx_filenames_with_dates), frame_indices, keyframe_paths)
+    folium_map = create_folium_map(center_lat, center_lon, zoom_level)
+    first_frame = 0
+    # Segments added so far, kept only for saving keyframes
+    route_segments = []
+    if keyframe is not None:
+        first_frame, state = keyframe
+        for route, latitudes, longitudes in get_state_segments(state):
+            color = YEAR_COLORS.get(gpx_filenames_with_dates[route][1].year, '#000000')
+            folium.PolyLine(list(zip(latitudes.tolist(), longitudes.tolist())), color=color, weight=3.5, opacity=1).add_to(folium_map)
+        if keyframe_paths:
+            route_segments = get_state_segments(state)
+
+    print('Creating html maps.')
+    html_paths = []
+    total_points_in = 0
+    total_points_out = 0
+    for current_map, (file_path, date) in enumerate(gpx_filenames_with_dates):
+        if current_map < first_frame:
+            continue
+        if current_map in keyframe_paths:
+            save_keyframe(keyframe_paths[current_map], current_map, get_segments_state(route_segments))
+        if current_map > last_frame:
+            break
+        color = YEAR_COLORS.get(date.year, '#000000')
+        segments, points_in, points_out = simplify_route(zoom_level, get_segment_arrays_from_gpx(file_path))
+        total_points_in += points_in
+        total_points_out += points_out
+        for latitudes, longitudes in segments:
+            segment_coords = list(zip(latitudes.tolist(), longitudes.tolist()))
+            folium.PolyLine(segment_coords, color=color, weight=3.5, opacity=1).add_to(folium_map)
+        if keyframe_paths:
+            route_segments.extend((current_map, latitudes, longitudes) for latitudes, longitudes in segments)
+        
+        if current_map in frame_indices:
+            output_filename = str(current_map).zfill(8) + '.html'
+            output_path = os.path.join(current_directory, 'html_maps', output_filename)
+            html_paths.append(output_path)
+            save_map(folium_map, output_path)
+        progress_bar = create_progress_bar_string(current_map + 1, len(gpx_filenames_with_dates), width=50)
+        print(f'\r{progress_bar} {current_map + 1} / {len(gpx_filenames_with_dates)}       ', end ='')
+    print('\r                                                                                                 \r')
+    print_simplification(total_points_in, total_points_out)
+    return html_paths
+
+
+def create_single_page_map(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, filename='timelapse.html'):
+    """Create one html map with all routes, which are revealed frame by frame with JavaScript"""
+    print('Creating html map.')
+    folium_map = create_folium_map(center_lat, center_lon, zoom_level)
+    add_single_page_tracks(folium_map, gpx_filenames_with_dates, zoom_level)
+    html_path = os.path.join(current_directory, 'html_maps', filename)
+    save_map(folium_map, html_path)
+    return html_path
+
+
+def get_capture_tasks(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices, output_folder=OUTPUT_FOLDER, keyframe=None,
+                      single_page_filename='timelapse.html'):
+    """Create the html maps and get the capture task of each frame index, see capture_frames"""
+    last_frame_index = len(gpx_filenames_with_dates) - 1
+    dates = [gpx_filenames_with_dates[index][1] for index in frame_indices]
+    if SINGLE_PAGE_MAP:
+        with stage('html_maps'):
+            html_path = create_single_page_map(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, single_page_filename)
+        return [(index, html_path, date, last_frame_index, True, output_folder) for index, date in zip(frame_indices, dates)]
+
+    with stage('html_maps'):
+        html_paths = create_html_maps(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices, keyframe)
+    return [(index, html_path, date, last_frame_index, False, output_folder)
+            for index, html_path, date in zip(frame_indices, html_paths, dates)]
+
+
+def plan_shards(renderer, gpx_filenames_with_dates, view, size, tile_ranges, settings, frame_indices, shard_count, job_folder):
+    """Split the frames to render into shards and save the keyframe each shard starts from into the job folder.
+    The keyframes take one pass over the routes that only draws them, without saving or capturing any frames."""
+    shutil.rmtree(os.path.join(current_directory, job_folder), ignore_errors=True)
+    os.makedirs(os.path.join(current_directory, job_folder, 'keyframes'))
+    shards = get_shards(frame_indices, shard_count)
+    # The single page map has all routes in it, so its shards don't need keyframes
+    keyframe_paths = {}
+    if renderer != 'html' or not SINGLE_PAGE_MAP:
+        keyframe_paths = {shard['first_frame']: get_keyframe_path(job_folder, shard['first_frame'])
+                          for shard in shards if shard['first_frame'] > 0}
+
+    zoom_level, center_lat, center_lon, _ = view
+    if keyframe_paths:
+        print(f'Saving the keyframes of {len(shards)} shards.')
+        if renderer == 'html':
+            create_html_maps(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, (), keyframe_paths=keyframe_paths)
+        else:
+            generate_frames = get_frame_generator(renderer)
+            for _ in generate_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, size[0], size[1], (),
+                                     keyframe_paths=keyframe_paths):
+                pass
+    write_job(job_folder, renderer, gpx_filenames_with_dates, view, size, tile_ranges, settings, shards)
+    return shards
+
+def run_shard(job_folder, shard_index):
+    """Render a shard of a planned job into its folder in the job folder. Any machine with the same gpx files and configuration
+    can run shards of a job in a shared job folder. Frames a stopped run of the shard already finished are kept."""
+    job = load_job(job_folder)
+    if job is None:
+        print(f'Error: no render job found in {job_folder}.')
+        sys.exit(1)
+    if not 0 <= shard_index < len(job['shards']):
+        print(f'Error: the job has shards 0 to {len(job["shards"]) - 1}.')
+        sys.exit(1)
+    renderer = job['renderer']
+    gpx_filenames_with_dates = job['gpx_filenames_with_dates']
+    zoom_level, center_lat, center_lon, bounds = job['view']
+    width, height = job['size']
+    shard = job['shards'][shard_index]
+
+    # Frames of shards must look like the frames of a run without shards
+    settings = get_render_settings(renderer, zoom_level, center_lat, center_lon, bounds, (width, height))
+    if json.loads(json.dumps(settings)) != job['settings']:
+        print('Error: the configuration differs from the one the job was planned with.')
+        sys.exit(1)
+    changed_files = get_changed_files(job, shard['frame_indices'][-1])
+    if changed_files:
+        print(f'Error: {len(changed_files)} gpx files are missing or differ from the ones the job was planned with, e.g. {changed_files[0]}')
+        sys.exit(1)
+
+    print('Downloading map tiles.')
+    with stage('tiles'):
+        for tile_zoom, (min_x, max_x, min_y, max_y) in job['tile_ranges'].items():
+            download_tiles(tile_zoom, min_x, max_x, min_y, max_y, STADIA_API_KEY, export_files=renderer == 'html')
+
+    shard_folder = get_shard_folder(job_folder, shard_index)
+    os.makedirs(shard_folder, exist_ok=True)
+    frame_indices = [frame_index for frame_index in shard['frame_indices']
+                     if not is_frame_done(frame_index, len(gpx_filenames_with_dates), shard_folder)]
+    keyframe_path = get_keyframe_path(job_folder, shard['first_frame'])
+    keyframe = load_keyframe(keyframe_path) if os.path.exists(keyframe_path) else None
+    print(f'Rendering frames {shard["frame_indices"][0]} to {shard["frame_indices"][-1]} of shard {shard_index}.')
+    if not frame_indices:
+        pass
+    elif renderer == 'html':
+        # Shards running side by side each capture a single page map of their own, as the maps need to be next to the map tiles
+        capture_tasks = get_capture_tasks(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices, shard_folder, keyframe,
+                                          f'timelapse_shard_{shard_index}.html')
+        with stage('capture'):
+            capture_html_frames(capture_tasks)
+    else:
+        with stage('native_render'):
+            render_native_frames(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, width, height, shard_folder,
+                                 frame_indices, get_frame_generator(renderer), keyframe)
+
+def run_shards(job_folder, shards):
+    """Run every shard of a job in a process of its own. The output of each shard goes into shard.log in its folder."""
+    processes = []
+    for shard_index in range(len(shards)):
+        shard_folder = get_shard_folder(job_folder, shard_index)
+        os.makedirs(shard_folder, exist_ok=True)
+        with open(os.path.join(shard_folder, 'shard.log'), 'w', encoding='utf-8') as log_file:
+            processes.append(subprocess.Popen([sys.executable, os.path.join(current_directory, 'workout_map.py'),
+                                               '--run-shard', str(shard_index), '--job-folder', job_folder],
+                                              stdout=log_file, stderr=subprocess.STDOUT))
+    failed_shards = []
+    for shard_index, process in enumerate(processes):
+        if process.wait() != 0:
+            failed_shards.append(shard_index)
+        progress_bar = create_progress_bar_string(shard_index + 1, len(processes), width=50)
+        print(f'\r{progress_bar} {shard_index + 1} / {len(processes)}       ', end='')
+    print('\r                                                                                                 \r')
+    for shard_index in failed_shards:
+        print(f'Shard {shard_index} failed, see {os.path.join(get_shard_folder(job_folder, shard_index), "shard.log")}')
+
+def merge_job(job_folder):
+    """Move the frames of the shards of a job into the output folder, and write the video if OUTPUT_VIDEO is set"""
+    job = load_job(job_folder)
+    if job is None:
+        print(f'Error: no render job found in {job_folder}.')
+        sys.exit(1)
+    unfinished_shards = merge_shards(job_folder, job)
+    if unfinished_shards:
+        print(f'Error: shards not finished yet: {", ".join(str(shard_index) for shard_index in unfinished_shards)}. '
+              'Run them with --run-shard and merge again.')
+        sys.exit(1)
+
+    gpx_filenames_with_dates = job['gpx_filenames_with_dates']
+    frame_count = len(gpx_filenames_with_dates)
+    if OUTPUT_VIDEO:
+        # All frames are in the output folder now, so they're put into the video like the frames of an earlier run
+        print('Writing the frames into a video.')
+        with stage('video'):
+            image_paths = write_video([], gpx_filenames_with_dates, os.path.join(current_directory, OUTPUT_FOLDER, OUTPUT_VIDEO),
+                                      range(frame_count))
+    else:
+        image_paths = get_image_paths(frame_count)
+    write_image_list(image_paths)
+    shutil.rmtree(os.path.join(current_directory, job_folder), ignore_errors=True)
+    print(f'{len(job["shards"])} shards merged.')
+
+
+def main(renderer=RENDERER, resume=RESUME, report=RUN_REPORT, profile_stages=PROFILE_STAGES,
+         select_bounds=SELECT_BOUNDS, start_date=SELECT_START_DATE, end_date=SELECT_END_DATE,
+         shard_count=None, plan_only=False, job_folder=RENDER_JOB_FOLDER):
+    clear_screen()
+    print('-- GPX timelapse creator --\n')
+
+    targets = get_output_targets()
+    if OUTPUT_TARGETS and renderer == 'html':
+        print('Error: OUTPUT_TARGETS needs the native or heatmap renderer.')
+        sys.exit(1)
+    if len({target['name'] for target in targets}) != len(targets):
+        print('Error: every one of OUTPUT_TARGETS needs a name of its own.')
+        sys.exit(1)
+    if OUTPUT_TARGETS and shard_count:
+        print('Error: sharded rendering renders one output, so it can\'t be used with OUTPUT_TARGETS.')
+        sys.exit(1)
+
+    # When resuming, the frames that are still valid are kept and the rest are deleted once they're known
+    if CLEAR_OUTPUT_FOLDER and not resume:
+        clear_directory(OUTPUT_FOLDER)
+    for target in targets:
+        os.makedirs(os.path.join(current_directory, target['output_folder']), exist_ok=True)
+        if CLEAR_OUTPUT_FOLDER and not resume:
+            clear_directory(target['output_folder'])
+    clear_directory('html_maps')
+    if report or profile_stages:
+        start_run_report(profile_stages)
+        
+    selecting = select_bounds is not None or start_date is not None or end_date is not None
+    catalog_summary = None
+    if ACTIVITY_CATALOG:
+        with stage('catalog'):
+            gpx_filenames_with_dates, catalog_summary = get_selected_activities(number_of_workers, select_bounds, start_date, end_date)
+        gpx_files = [file_path for file_path, _ in gpx_filenames_with_dates]
+    elif selecting:
+        print('Error: selecting activities by area or date needs ACTIVITY_CATALOG.')
+        sys.exit(1)
+    else:
+        gpx_files = [os.path.join(INPUT_FOLDER, f) for f in os.listdir(INPUT_FOLDER) if f.endswith('.gpx')]
+    if not gpx_files:
+        print('Error: no gpx files selected.' if selecting else 'Error: no gpx files found in input folder.')
+        sys.exit(1)
+    else:
+        print(f'{len(gpx_files)} gpx files {"selected" if selecting else "found"}.\n')
+   
+    print(f'Searching for map bounds.')
+    with stage('bounds'):
+        center_lat, center_lon, min_lat, max_lat, min_lon, max_lon = get_center_and_bounds(gpx_files, number_of_workers, catalog_summary)
+    if VERBOSE_OUTPUT:
+        print(f'latitude {min_lat} to {max_lat}\nlongitude {min_lon} to {max_lon}')
+
+    # Each target has a map view of its own, but they all draw on the same tiles
+    views = [get_target_view(target, center_lat, center_lon, min_lat, max_lat, min_lon, max_lon, resume) for target in targets]
+    tile_ranges = get_tile_ranges(targets, views)
+    if VERBOSE_OUTPUT:
+        for target, (zoom_level, *_) in zip(targets, views):
+            print(f'{target["name"] or "map"} zoom level {zoom_level}')
+        for tile_zoom, (min_x, max_x, min_y, max_y) in tile_ranges.items():
+            print(f'zoom {tile_zoom} tiles x {min_x} to {max_x}\nzoom {tile_zoom} tiles y {min_y} to {max_y}')
+
+    print(f'\nDownloading map tiles.')
+    with stage('tiles'):
+        for tile_zoom, (min_x, max_x, min_y, max_y) in tile_ranges.items():
+            download_tiles(tile_zoom, min_x, max_x, min_y, max_y, STADIA_API_KEY, export_files=renderer == 'html')
+
+    if not ACTIVITY_CATALOG:
+        if VERBOSE_OUTPUT:
+            print('\nGetting date and time in gpx files.')
+        with stage('dates'):
+            gpx_filenames_with_dates = get_gpx_filenames_and_dates()  # list of tuples (filename, date)
+
+    frame_count = len(gpx_filenames_with_dates)
+    target_settings = []
+    target_frame_indices = []
+    with stage('manifest'):
+        # The gpx files behind the frames are the same for every target, only the settings differ
+        manifest = create_manifest(gpx_filenames_with_dates, None)
+        for target, (zoom_level, target_lat, target_lon, bounds) in zip(targets, views):
+            settings = get_render_settings(renderer, zoom_level, target_lat, target_lon, bounds, target['size'])
+            target_settings.append(settings)
+            target_frame_indices.append(prepare_frames({**manifest, 'settings': settings}, resume, target['output_folder']))
+    if resume:
+        for target, frame_indices in zip(targets, target_frame_indices):
+            print(f'Resuming{" " + target["name"] if target["name"] else ""}: '
+                  f'{frame_count - len(frame_indices)} of {frame_count} frames are still valid.\n')
+
+    if shard_count:
+        with stage('keyframes'):
+            shards = plan_shards(renderer, gpx_filenames_with_dates, views[0], targets[0]['size'], tile_ranges, target_settings[0],
+                                 target_frame_indices[0], shard_count, job_folder)
+        if plan_only:
+            print(f'{len(shards)} shards planned in {job_folder}. Run each of them with --run-shard INDEX --job-folder {job_folder}, '
+                  f'on this machine or others sharing the folder, and put them together with --merge --job-folder {job_folder}.')
+            return
+        print(f'Rendering {len(shards)} shards.')
+        with stage('shards'):
+            run_shards(job_folder, shards)
+        with stage('merge'):
+            merge_job(job_folder)
+    elif renderer != 'html':
+        render_targets(renderer, targets, gpx_filenames_with_dates, views, target_frame_indices)
+    else:
+        zoom_level, center_lat, center_lon, _ = views[0]
+        frame_indices = target_frame_indices[0]
+        if OUTPUT_VIDEO:
+            reused_frames = set(range(frame_count)) - set(frame_indices)
+            frames = []
+            if frame_indices:
+                capture_tasks = get_capture_tasks(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices)
+                print('Capturing html maps into a video.')
+                frames = capture_frames(capture_tasks, stream=True)
+            # Capturing the frames and writing the video run together
+            with stage('video'):
+                image_paths = write_video(frames, gpx_filenames_with_dates, os.path.join(current_directory, OUTPUT_FOLDER, OUTPUT_VIDEO), reused_frames)
+        else:
+            if frame_indices:
+                capture_tasks = get_capture_tasks(gpx_filenames_with_dates, zoom_level, center_lat, center_lon, frame_indices)
+                with stage('capture'):
+                    capture_html_frames(capture_tasks)
+            image_paths = get_image_paths(frame_count)
+        write_image_list(image_paths)
+
+    if report or profile_stages:
+        print_run_report(write_run_report())
+    print('All done ^_^ _b')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create timelapse images out of GPX files.')
+    parser.add_argument('--renderer', choices=['html', 'native', 'heatmap'], default=RENDERER,
+                        help='html: capture folium maps with Chrome, native: draw the routes directly on the map tiles, '
+                             'heatmap: color the map tiles by how many routes pass through each pixel')
+    parser.add_argument('--resume', action=argparse.BooleanOptionalAction, default=RESUME,
+                        help='keep the frames of the previous run up to the first new or changed gpx file, and render only the rest')
+    parser.add_argument('--report', action=argparse.BooleanOptionalAction, default=RUN_REPORT,
+                        help='write a report of the time and resources each stage took into the output folder')
+    parser.add_argument('--profile', nargs='+', default=PROFILE_STAGES, metavar='STAGE',
+                        help='profile these stages or work items with cProfile, and write the profiles next to the report')
+    parser.add_argument('--bbox', nargs=4, type=float, default=SELECT_BOUNDS, metavar=('MIN_LAT', 'MAX_LAT', 'MIN_LON', 'MAX_LON'),
+                        help='render only the activities whose routes are in this area, using the activity catalog')
+    parser.add_argument('--start', default=SELECT_START_DATE, metavar='DATE',
+                        help='render only the activities that start on or after this date, e.g. 2023-01-01')
+    parser.add_argument('--end', default=SELECT_END_DATE, metavar='DATE',
+                        help='render only the activities that start before this date')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='split the frames into N shards, each rendered by a process of its own from a keyframe of the map at its first frame')
+    parser.add_argument('--plan-only', action='store_true',
+                        help='with --shards, only plan the shards into the job folder, to run them with --run-shard on this or other machines')
+    parser.add_argument('--run-shard', type=int, metavar='INDEX', help='render a shard of the job in the job folder')
+    parser.add_argument('--merge', action='store_true', help='put the finished shards of the job in the job folder into the output folder')
+    parser.add_argument('--job-folder', default=RENDER_JOB_FOLDER, help='folder of the sharded render job')
+    args = parser.parse_args()
+    if args.run_shard is not None:
+        run_shard(args.job_folder, args.run_shard)
+    elif args.merge:
+        merge_job(args.job_folder)
+    else:
+        main(renderer=args.renderer, resume=args.resume, report=args.report, profile_stages=args.profile,
+             select_bounds=args.bbox, start_date=args.start, end_date=args.end,
+             shard_count=args.shards, plan_only=args.plan_only, job_folder=args.job_folder)